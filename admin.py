@@ -0,0 +1,167 @@
+# admin.py
+import asyncio
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import time
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response
+from starlette.datastructures import Headers
+
+from loop_monitor import loop_monitor
+
+try:
+    from pyinstrument import Profiler as SamplingProfiler
+except ImportError:
+    SamplingProfiler = None
+
+
+# Admin endpoints are off unless this is set, and then need it in X-Admin-Token
+ADMIN_TOKEN_ENV = "NKP_ADMIN_TOKEN"
+# Longest profiling window, and longest a profiled request may take
+MAX_PROFILE_SECONDS = 60
+# Functions listed in a cProfile report
+PROFILE_TOP_FUNCTIONS = 60
+
+
+def is_admin(token: Optional[str]) -> bool:
+    expected = os.environ.get(ADMIN_TOKEN_ENV)
+    return bool(expected) and token is not None and hmac.compare_digest(token.encode(), expected.encode())
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not os.environ.get(ADMIN_TOKEN_ENV):
+        # Don't advertise the endpoints when they're disabled
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+
+class Profile:
+    """Profiles the event loop thread between ``start`` and ``stop``.
+
+    Uses pyinstrument's sampling profiler when it is installed, cProfile
+    otherwise. Either way everything the loop thread runs is seen, other
+    requests included, but work handed to the DB writer thread only shows up
+    as the time the loop spent awaiting it.
+    """
+
+    def __init__(self, engine: str = "auto"):
+        if engine == "auto":
+            engine = "pyinstrument" if SamplingProfiler is not None else "cprofile"
+        if engine == "pyinstrument" and SamplingProfiler is None:
+            raise HTTPException(status_code=400, detail="pyinstrument is not installed")
+        if engine not in ("pyinstrument", "cprofile"):
+            raise HTTPException(status_code=400, detail=f"Unknown profiler {engine!r}")
+        self.engine = engine
+        self._profiler = SamplingProfiler(async_mode="disabled") if engine == "pyinstrument" else cProfile.Profile()
+
+    def start(self):
+        if self.engine == "pyinstrument":
+            self._profiler.start()
+        else:
+            self._profiler.enable()
+
+    def stop(self):
+        if self.engine == "pyinstrument":
+            self._profiler.stop()
+        else:
+            self._profiler.disable()
+
+    def response(self, headers: Optional[dict] = None) -> Response:
+        if self.engine == "pyinstrument":
+            return HTMLResponse(self._profiler.output_html(), headers=headers)
+        report = io.StringIO()
+        pstats.Stats(self._profiler, stream=report).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+        return PlainTextResponse(report.getvalue(), headers=headers)
+
+
+# One profile at a time, profilers don't nest
+_profiling = asyncio.Lock()
+
+
+def _busy():
+    return HTTPException(status_code=409, detail="A profile is already being captured")
+
+
+router = APIRouter(prefix="/admin", dependencies=[Depends(require_admin)])
+
+
+@router.get("/loop")
+async def get_loop_report():
+    """Event loop lag and the stacks of recent stalls, newest first."""
+    return loop_monitor.report()
+
+
+@router.post("/profile")
+async def profile_window(seconds: float = Query(10, gt=0, le=MAX_PROFILE_SECONDS), engine: str = "auto"):
+    """Profile whatever the server does for the next ``seconds`` and return the report."""
+    if _profiling.locked():
+        raise _busy()
+    async with _profiling:
+        profile = Profile(engine)
+        profile.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profile.stop()
+    return profile.response()
+
+
+class ProfileMiddleware:
+    """ASGI middleware: a request sent with ``X-Profile: <engine or 1>`` and a
+    valid ``X-Admin-Token`` is answered with its profile instead of its
+    response.
+
+    The whole response, streamed or not, is produced inside the profile and
+    discarded, up to MAX_PROFILE_SECONDS. Other requests pass straight
+    through.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = Headers(scope=scope)
+        engine = headers.get("x-profile")
+        if not engine or not is_admin(headers.get("x-admin-token")):
+            return await self.app(scope, receive, send)
+
+        # Exception handlers don't cover middleware, answer errors directly
+        try:
+            if _profiling.locked():
+                raise _busy()
+            profile = Profile("auto" if engine == "1" else engine)
+        except HTTPException as error:
+            return await JSONResponse({"detail": error.detail}, status_code=error.status_code)(scope, receive, send)
+
+        status, body = None, 0
+
+        async def discard(message):
+            nonlocal status, body
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                body += len(message.get("body", b""))
+
+        async with _profiling:
+            started = time.perf_counter()
+            profile.start()
+            try:
+                await asyncio.wait_for(self.app(scope, receive, discard), timeout=MAX_PROFILE_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                profile.stop()
+        response = profile.response(headers={
+            "X-Profile-Status": str(status),
+            "X-Profile-Body-Bytes": str(body),
+            "X-Profile-Seconds": f"{time.perf_counter() - started:.3f}",
+        })
+        await response(scope, receive, send)
@@ -1,170 +1,246 @@
-from fastapi import FastAPI, Request
-from fastapi.responses import StreamingResponse, JSONResponse
-import asyncio
-from fastapi.templating import Jinja2Templates
-
-
-app = FastAPI()
-
-templates = Jinja2Templates(directory="templates")
-
-def handle_command_creation(deployment: dict):
-    flags = {
-        # Control plane
-
-        "cluster-name": {"required": True},
-        "control-plane-endpoint-ip": {"required": True},
-        "control-plane-prism-element-cluster": {"required": True},
-        "control-plane-subnets": {"required": True},
-        "control-plane-vm-image": {"required": True},
-        # "control-plane-cores-per-vcpu": {"required": False},
-        # "control-plane-disk-size": {"required": False},
-        # "control-plane-endpoint-port": {"required": False},
-        # "control-plane-memory": {"required": False},
-        # "control-plane-pc-project": {"required": False},
-        # "control-plane-vcpus": {"required": False},
-        # "control-plane-replicas": {"required": False},
-
-        
-        # CSI
-
-        "csi-storage-container":{"required": True},
-        
-        # Endpoint for Prism central
-
-        "endpoint": {"required": True},
-
-        # Kubernetes
-
-        "kubernetes-service-load-balancer-ip-range": {"required": True},
-        # "kubernetes-pod-network-cidr": {"required": False},
-        # "kubernetes-service-cidr": {"required": False},
-        # "kubernetes-version": {"required": False},
-        # "namespace": {"required": False},
-        
-        # Registry
-
-        # "registry-cacert": {"required": False},
-        # "registry-mirror-cacert": {"required": False},
-        # "registry-mirror-password": {"required": False},
-        # "registry-mirror-url": {"required": False},
-        # "registry-mirror-username": {"required": False},
-        "registry-password": {"required": True},
-        "registry-url": {"required": True},
-        "registry-username": {"required": True},
-        
-        # Cluster management
-
-        # "ssh-public-key-file":{"required": False},
-        # "ssh-username": {"required": False},
-
-        # Timeout
-
-        # "timeout":{"required": False},
-
-        # VM image
-
-        "vm-image": {"required": True},
-
-        # Worker
-
-        # "worker-cores-per-vcpu":{"required": False},
-        # "worker-disk-size": {"required": False},
-        # "worker-memory": {"required": False},
-        # "worker-pc-categories": {"required": False},
-        # "worker-pc-project": {"required": False},
-        # "worker-replicas": {"required": False},
-        # "worker-vcpus": {"required": False},
-        "worker-prism-element-cluster": {"required": True},
-        "worker-subnets": {"required": True},
-        "worker-vm-image":{"required": True},
-    }
-    missing = [flag for flag, prop in flags.items() if prop["required"] and flag not in deployment]
-
-    if "vm-image" in deployment:
-        missing = [m for m in missing if m not in ("worker-vm-image", "control-plane-vm-image")]
-
-    # Remove "vm-image" from missing if both "worker-vm-image" and "control-plane-vm-image" are present
-    elif "worker-vm-image" in deployment and "control-plane-vm-image" in deployment:
-        if "vm-image" in missing:
-            missing.remove("vm-image")
-
-    if missing:
-        raise ValueError(f"Missing required flags: {" ".join(missing)}")
-
-    # Step 2: Build the command
-    base_command = ["nkp", "create", "cluster", "nutanix "]  # Example
-    for flag, value in deployment.items():
-        base_command.append(f"--{flag}={value}")
-
-    base_command.append("--insecure")
-    base_command.append("--self-managed")
-
-    # Final command string
-    final_command = " ".join(base_command) 
-    print(final_command)
-    return final_command
-
-def deploy_cluster(command: str):
+from fastapi import APIRouter, FastAPI, Header, Query, Request
+from fastapi.responses import Response, JSONResponse
+import json
+import os
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from pydantic import BaseModel, Field
+
+from admin import ProfileMiddleware, router as admin_router
+from batches import MAX_BATCH_SIZE, InvalidBatch, batches, start_batch, validate_batch
+from deployments import DEFAULT_OVERFLOW_POLICY, MAX_CONCURRENT_DEPLOYMENTS, SUBSCRIBER_QUEUE_SIZE, \
+    DeploymentConflict, IdempotencyKeyReused, coalesce_events, event_log_path, find_conflict, follow_remote, \
+    load_result, output_log_path, reattach_runs, remote_status, runs, submit_run, replay_from_log
+from event_bus import event_bus
+from fanout import OverflowPolicy, SubscriberOverflow, batched
+from log_archive import LogArchive, archive_response
+from loop_monitor import loop_monitor
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, render as render_metrics
+from nkp_command import InvalidFlags, build_argv
+from process_output import OutputEvent
+from sse import DEFAULT_BATCH_LINES, MAX_BATCH_WINDOW_MS, event_stream_response, format_sse
+from templating import templates_for
+
+
+router = APIRouter()
+
+class BatchDeployment(BaseModel):
+    # Each one as /deploy/management takes it
+    deployments: List[Dict[str, Any]] = Field(min_length=1, max_length=MAX_BATCH_SIZE)
+    # Deployments of the batch running at once, on top of the scheduler's limits
+    parallelism: int = Field(MAX_CONCURRENT_DEPLOYMENTS, ge=1)
+    # Start no more deployments once one has failed
+    stop_on_failure: bool = False
+    priority: int = 0
+
+def handle_command_creation(deployment: dict) -> List[str]:
+    # Validated against the nkp_command schema, raises InvalidFlags
+    return build_argv(deployment)
+
+def output_sse(event_id: int, event: OutputEvent) -> str:
+    return format_sse(json.dumps(event.to_dict()), event=event.source, event_id=event_id)
+
+def stream_run(job_id: str, last_event_id: int = 0, overflow: OverflowPolicy = DEFAULT_OVERFLOW_POLICY,
+               window_ms: int = 0, max_lines: int = DEFAULT_BATCH_LINES, accept_encoding: Optional[str] = None):
+    """A deployment's events as SSE. With ``window_ms``, lines arriving within
+    that many milliseconds are sent together (sooner once ``max_lines`` are
+    waiting), lines of the same source merged into one event under the
+    newest id.
+    """
+    run = runs.get(job_id)
+    remote = False
+    if run is None:
+        if not os.path.exists(event_log_path(job_id)):
+            return JSONResponse({"error": "Deployment not found"}, status_code=404)
+        # Running on another worker, follow it through the event bus
+        remote = event_bus.cross_process and load_result(job_id) is None
+        # Otherwise not running anymore, replay what was persisted
+        persisted = None if remote else replay_from_log(job_id, last_event_id)
+
+    async def events():
+        if run is not None:
+            async for entry in run.follow(last_event_id, overflow):
+                yield entry
+        elif remote:
+            async for entry in follow_remote(job_id, last_event_id):
+                yield entry
+        else:
+            for entry in persisted:
+                yield entry
+
+    async def command_stream():
+        try:
+            if window_ms:
+                window = window_ms / 1000
+                async for entries in batched(events(), window, max_lines, coalesce_events, SUBSCRIBER_QUEUE_SIZE):
+                    yield "".join(output_sse(event_id, event) for event_id, event in entries)
+            else:
+                async for event_id, event in events():
+                    yield output_sse(event_id, event)
+            yield format_sse("[DONE]")
+        except SubscriberOverflow:
+            # End without [DONE] so the client reconnects from its last event id
+            notice = OutputEvent("system", "Viewer fell behind, reconnecting", time.time())
+            yield format_sse(json.dumps(notice.to_dict()), event=notice.source)
+        except Exception as e:
+            error = OutputEvent("system", f"Exception occurred: {str(e)}", time.time())
+            yield format_sse(json.dumps(error.to_dict()), event=error.source)
+
+    return event_stream_response(command_stream(), "deployments", accept_encoding, {"X-Job-Id": job_id})
+
+def conflict_response(e: DeploymentConflict):
+    status_code = 422 if isinstance(e, IdempotencyKeyReused) else 409
+    return JSONResponse({"error": str(e), "job_id": e.run.job_id}, status_code=status_code)
+
+def deploy_cluster(argv: List[str], overflow: OverflowPolicy = DEFAULT_OVERFLOW_POLICY,
+                   endpoint: Optional[str] = None, priority: int = 0, idempotency_key: Optional[str] = None,
+                   window_ms: int = 0, max_lines: int = DEFAULT_BATCH_LINES, accept_encoding: Optional[str] = None):
     try:
-        async def command_stream():
-            try:
-                # Open the file for writing
-                # with open("deployment.log", 'w') as file:
-                    # Create the process
-                cmd = ["bash", "-c", command]
-                process = await asyncio.create_subprocess_exec(
-                    *cmd,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE,
-                )
-                
-                # Yield SSE format for start message
-                yield f"data: Command started: {' '.join(command)}"
-                
-                # Read output line by line
-                while True:
-                    line = await process.stdout.readline()
-                    if not line:
-                        break
-                    
-                    # Decode the line
-                    line_str = line.decode('utf-8')
-                    
-                    # Write to file
-                    # file.write(line_str)
-                    # file.flush()
-                    
-                    # Yield in SSE format
-                    yield f"data: {line_str.strip()}\n\n"
-                    
-                stderr_data = await process.stderr.read()
-                if stderr_data:
-                    yield f"ERROR: {stderr_data.decode('utf-8')}"
-                
-                # Wait for the process to complete
-                return_code = await process.wait()
-                
-                # Yield completion message with return code
-                yield f"data: Command completed with return code: {return_code}\n\n"
-                yield f"data: Output saved to deployment.log\n\n"
-                yield "data: [DONE]\n\n"
-            except Exception as e:
-                yield f"Exception occurred: {str(e)}"
-
-        return StreamingResponse(
-            command_stream(),
-            media_type="text/event-stream"
-        )
+        run, created = submit_run(argv, endpoint, priority, idempotency_key)
+    except DeploymentConflict as e:
+        return conflict_response(e)
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
+    response = stream_run(run.job_id, 0, overflow, window_ms, max_lines, accept_encoding)
+    if not created:
+        # A repeat of a request already underway, streamed from its first event
+        response.headers["X-Coalesced"] = "true"
+    return response
 
 
-@app.get("/")
+@router.get("/")
 async def get_index(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
-
-@app.post("/deploy/management")
-def handle_deployment(deployment: dict):
-    command = handle_command_creation(deployment)
-    return deploy_cluster(command)
\ No newline at end of file
+    return templates_for().TemplateResponse(request, "index.html")
+
+@router.post("/deploy/management")
+async def handle_deployment(deployment: dict, overflow: OverflowPolicy = DEFAULT_OVERFLOW_POLICY, priority: int = 0,
+                            idempotency_key: Optional[str] = Header(None),
+                            window_ms: int = Query(0, ge=0, le=MAX_BATCH_WINDOW_MS),
+                            max_lines: int = Query(DEFAULT_BATCH_LINES, ge=1),
+                            accept_encoding: Optional[str] = Header(None)):
+    try:
+        argv = handle_command_creation(deployment)
+    except InvalidFlags as e:
+        return JSONResponse({"error": "Invalid deployment flags", "flags": e.errors}, status_code=422)
+    return deploy_cluster(argv, overflow, deployment.get("endpoint"), priority, idempotency_key,
+                          window_ms, max_lines, accept_encoding)
+
+@router.post("/deploy/management/batch", status_code=202)
+async def handle_batch_deployment(batch: BatchDeployment):
+    # Nothing starts unless every deployment is valid
+    try:
+        argvs = validate_batch(batch.deployments, handle_command_creation)
+    except InvalidBatch as e:
+        return JSONResponse({"error": "Invalid deployment flags", "deployments": {
+            str(index): errors for index, errors in e.errors.items()
+        }}, status_code=422)
+    conflicts = {index: find_conflict(argv) for index, argv in enumerate(argvs)}
+    conflicts = {str(index): run.job_id for index, run in conflicts.items() if run is not None}
+    if conflicts:
+        return JSONResponse({"error": "Clusters already being deployed with other flags",
+                             "deployments": conflicts}, status_code=409)
+    started = start_batch(batch.deployments, argvs, batch.parallelism, batch.stop_on_failure, batch.priority)
+    return {**started.status(), "stream": f"/deploy/management/batch/{started.batch_id}/stream"}
+
+@router.get("/deploy/management/batch/{batch_id}")
+async def get_batch_status(batch_id: str):
+    batch = batches.get(batch_id)
+    if batch is None:
+        return JSONResponse({"error": "Batch not found"}, status_code=404)
+    return {**batch.status(), "last_event_id": batch.events.last_id}
+
+@router.get("/deploy/management/batch/{batch_id}/stream")
+async def stream_batch(batch_id: str, last_event_id: int = Header(0), after: Optional[int] = None,
+                       output: bool = True, overflow: OverflowPolicy = DEFAULT_OVERFLOW_POLICY,
+                       window_ms: int = Query(0, ge=0, le=MAX_BATCH_WINDOW_MS),
+                       max_lines: int = Query(DEFAULT_BATCH_LINES, ge=1),
+                       accept_encoding: Optional[str] = Header(None)):
+    """Status snapshots of the whole batch and, unless ?output=false, every
+    deployment's output tagged with its index and job id. Each deployment's
+    own stream is /deploy/management/{job_id}/stream. ?window_ms= sends
+    events arriving within the window together, as for a deployment.
+    """
+    batch = batches.get(batch_id)
+    if batch is None:
+        return JSONResponse({"error": "Batch not found"}, status_code=404)
+
+    def batch_sse(event_id: int, message: dict) -> str:
+        return format_sse(json.dumps(message), event=message["type"], event_id=event_id)
+
+    async def batch_stream():
+        events = batch.follow(after if after is not None else last_event_id, output, overflow)
+        try:
+            if window_ms:
+                async for entries in batched(events, window_ms / 1000, max_lines, max_buffered=SUBSCRIBER_QUEUE_SIZE):
+                    yield "".join(batch_sse(event_id, message) for event_id, message in entries)
+            else:
+                async for event_id, message in events:
+                    yield batch_sse(event_id, message)
+            yield format_sse("[DONE]")
+        except SubscriberOverflow:
+            # End without [DONE] so the client reconnects from its last event id
+            notice = OutputEvent("system", "Viewer fell behind, reconnecting", time.time())
+            yield format_sse(json.dumps(notice.to_dict()), event=notice.source)
+
+    return event_stream_response(batch_stream(), "batches", accept_encoding, {"X-Batch-Id": batch_id})
+
+@router.get("/deploy/management/{job_id}")
+async def get_deployment_status(job_id: str):
+    try:
+        uuid.UUID(job_id)
+    except ValueError:
+        return JSONResponse({"error": "Deployment not found"}, status_code=404)
+    run = runs.get(job_id)
+    status = run.status() if run is not None else remote_status(job_id)
+    if status is None:
+        return JSONResponse({"error": "Deployment not found"}, status_code=404)
+    return status
+
+@router.get("/deploy/management/{job_id}/stream")
+async def resume_deployment(job_id: str, last_event_id: int = Header(0), after: Optional[int] = None,
+                            overflow: OverflowPolicy = DEFAULT_OVERFLOW_POLICY,
+                            window_ms: int = Query(0, ge=0, le=MAX_BATCH_WINDOW_MS),
+                            max_lines: int = Query(DEFAULT_BATCH_LINES, ge=1),
+                            accept_encoding: Optional[str] = Header(None)):
+    # Browsers send Last-Event-ID on reconnect; ?after= is for clients that can't set headers
+    try:
+        uuid.UUID(job_id)
+    except ValueError:
+        return JSONResponse({"error": "Deployment not found"}, status_code=404)
+    return stream_run(job_id, after if after is not None else last_event_id, overflow, window_ms, max_lines,
+                      accept_encoding)
+
+@router.get("/deploy/management/{job_id}/log")
+async def download_deployment_log(job_id: str, range_header: Optional[str] = Header(None, alias="Range"),
+                                  accept_encoding: Optional[str] = Header(None)):
+    try:
+        uuid.UUID(job_id)
+    except ValueError:
+        return JSONResponse({"error": "Deployment not found"}, status_code=404)
+    archive = LogArchive.open(output_log_path(job_id))
+    if archive is None:
+        return JSONResponse({"error": "Deployment not found"}, status_code=404)
+    return archive_response(archive, range_header, accept_encoding, f"{job_id}.log")
+
+@router.get("/metrics")
+async def get_metrics():
+    return Response(render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
+
+def create_app() -> FastAPI:
+    app = FastAPI()
+    app.include_router(admin_router)
+    app.include_router(router)
+    app.add_middleware(ProfileMiddleware)
+
+    @app.on_event("startup")
+    async def start_background_work():
+        loop_monitor.start()
+        event_bus.start()
+        reattach_runs()
+
+    return app
+
+app = create_app()
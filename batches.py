@@ -0,0 +1,216 @@
+# batches.py
+import asyncio
+import functools
+import uuid
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from deployments import DEFAULT_OVERFLOW_POLICY, FINISHED_RUN_RETENTION, RING_BUFFER_SIZE, SUBSCRIBER_QUEUE_SIZE, \
+    DeploymentConflict, DeploymentRun, submit_run
+from fanout import OverflowPolicy, RingBuffer, Subscriber
+from nkp_command import InvalidFlags, flag_value
+from process_output import OutputEvent
+
+
+# Most deployments one batch may hold
+MAX_BATCH_SIZE = 100
+
+
+class InvalidBatch(ValueError):
+    """Deployments of a batch failed validation; ``errors`` maps each one's index to its flag problems."""
+
+    def __init__(self, errors: Dict[int, Dict[str, str]]):
+        super().__init__(f"{len(errors)} invalid deployment(s)")
+        self.errors = errors
+
+
+def validate_batch(deployments: List[Dict[str, Any]], build: Callable[[Dict[str, Any]], List[str]]) -> List[List[str]]:
+    """Build the argv of every deployment with ``build``, before any is started.
+
+    Raises InvalidBatch listing every invalid deployment, including any that
+    would deploy a cluster name another deployment of the batch already does.
+    """
+    argvs: List[List[str]] = []
+    errors: Dict[int, Dict[str, str]] = {}
+    names: Dict[str, int] = {}
+    for index, deployment in enumerate(deployments):
+        try:
+            argv = build(deployment)
+        except InvalidFlags as e:
+            errors[index] = e.errors
+            continue
+        name = flag_value(argv, "cluster-name")
+        if name in names:
+            errors[index] = {"cluster-name": f"also deployed by deployment {names[name]} of this batch"}
+            continue
+        names[name] = index
+        argvs.append(argv)
+    if errors:
+        raise InvalidBatch(errors)
+    return argvs
+
+
+@dataclass
+class BatchMember:
+    index: int
+    cluster_name: Optional[str]
+    argv: List[str]
+    endpoint: Optional[str]
+    run: Optional[DeploymentRun] = None
+    skipped: bool = False
+    # Why it couldn't be started
+    error: Optional[str] = None
+
+    def status(self) -> dict:
+        status = {"index": self.index, "cluster_name": self.cluster_name, "error": self.error}
+        if self.run is None:
+            state = "failed" if self.error else "skipped" if self.skipped else "waiting"
+            return {**status, "job_id": None, "status": state, "phase": None, "progress": 0, "return_code": None}
+        run = self.run.status()
+        return {**status, "job_id": self.run.job_id, "status": run["status"], "phase": run["phase"],
+                "progress": run["progress"], "return_code": run["return_code"]}
+
+
+class DeploymentBatch:
+    """Deploys many clusters, at most ``parallelism`` at a time.
+
+    Deployments start in order as slots free up, and each still goes through
+    the deployment scheduler and its limits. With ``stop_on_failure`` the
+    first failed deployment stops any more from starting: running ones
+    finish, the rest are skipped.
+
+    The batch's events are numbered like a run's. They are status snapshots
+    of the whole batch, sent whenever a deployment starts, changes phase or
+    ends, and every deployment's output lines tagged with its index. Each
+    deployment can still be followed on its own by job id.
+    """
+
+    def __init__(self, members: List[BatchMember], parallelism: int,
+                 stop_on_failure: bool = False, priority: int = 0):
+        self.batch_id = str(uuid.uuid4())
+        self.members = members
+        self.parallelism = parallelism
+        self.stop_on_failure = stop_on_failure
+        self.priority = priority
+        self.events: RingBuffer[dict] = RingBuffer(RING_BUFFER_SIZE)
+        # Each viewer's queue, and whether it wants output lines too
+        self.subscribers: Dict[Subscriber, bool] = {}
+        self.stopped = False
+        self.done = False
+        self._task: Optional[asyncio.Task] = None
+
+    async def run(self):
+        slots = asyncio.Semaphore(self.parallelism)
+        watchers = []
+        try:
+            for member in self.members:
+                await slots.acquire()
+                if self.stopped:
+                    slots.release()
+                    break
+                try:
+                    # An identical deployment already underway is joined, not repeated
+                    member.run, _ = submit_run(member.argv, member.endpoint, self.priority)
+                except DeploymentConflict as e:
+                    member.error = str(e)
+                    slots.release()
+                    self._failed()
+                    self._publish_status()
+                    continue
+                member.run.listeners.append(functools.partial(self._on_run_event, member))
+                self._publish_status()
+                watchers.append(asyncio.create_task(self._watch(member, slots)))
+            await asyncio.gather(*watchers)
+        finally:
+            self.done = True
+            self._publish_status()
+            for subscriber in self.subscribers:
+                subscriber.close()
+            asyncio.get_running_loop().call_later(FINISHED_RUN_RETENTION, batches.pop, self.batch_id, None)
+
+    async def _watch(self, member: BatchMember, slots: asyncio.Semaphore):
+        try:
+            return_code = await member.run.wait()
+        finally:
+            slots.release()
+        if return_code != 0:
+            self._failed()
+        self._publish_status()
+
+    def _failed(self):
+        if self.stop_on_failure and not self.stopped:
+            self.stopped = True
+            for member in self.members:
+                member.skipped = member.run is None and member.error is None
+
+    def status(self) -> dict:
+        members = [member.status() for member in self.members]
+        counts = Counter(member["status"] for member in members)
+        if not self.done:
+            status = "stopping" if self.stopped else "running"
+        else:
+            status = "completed" if counts["completed"] == len(members) else "failed"
+        return {
+            "batch_id": self.batch_id,
+            "status": status,
+            "parallelism": self.parallelism,
+            "stop_on_failure": self.stop_on_failure,
+            "progress": sum(member["progress"] for member in members) // len(members),
+            "counts": dict(counts),
+            "deployments": members,
+        }
+
+    def _on_run_event(self, member: BatchMember, event_id: int, event: OutputEvent):
+        if event.source == "system":
+            # Queued, started, a new phase, the return code
+            self._publish_status()
+        else:
+            self._publish({"type": "output", "index": member.index, "cluster_name": member.cluster_name,
+                           "job_id": member.run.job_id, "event_id": event_id, **event.to_dict()})
+
+    def _publish_status(self):
+        self._publish({"type": "status", **self.status()})
+
+    def _publish(self, message: dict):
+        entry = self.events.append(message)
+        output = message["type"] == "output"
+        for subscriber, wants_output in self.subscribers.items():
+            if wants_output or not output:
+                subscriber.push(entry)
+
+    async def follow(self, last_event_id: int = 0, output: bool = True,
+                     policy: OverflowPolicy = DEFAULT_OVERFLOW_POLICY) -> AsyncIterator[Tuple[int, dict]]:
+        """Yield events after ``last_event_id`` still in memory, then the live tail."""
+        backlog = [entry for entry in self.events.since(last_event_id) if output or entry[1]["type"] != "output"]
+        subscriber = None
+        if not self.done:
+            subscriber = Subscriber(SUBSCRIBER_QUEUE_SIZE, policy)
+            self.subscribers[subscriber] = output
+        try:
+            for entry in backlog:
+                yield entry
+            if subscriber is not None:
+                async for entry in subscriber:
+                    yield entry
+        finally:
+            if subscriber is not None:
+                self.subscribers.pop(subscriber, None)
+
+
+# Batches started by this process, by batch id
+batches: Dict[str, DeploymentBatch] = {}
+
+
+def start_batch(deployments: List[Dict[str, Any]], argvs: List[List[str]], parallelism: int,
+                stop_on_failure: bool = False, priority: int = 0) -> DeploymentBatch:
+    """Start deploying validated ``deployments`` (see validate_batch)."""
+    members = [
+        BatchMember(index, flag_value(argv, "cluster-name"), argv, deployment.get("endpoint"))
+        for index, (deployment, argv) in enumerate(zip(deployments, argvs))
+    ]
+    batch = DeploymentBatch(members, parallelism, stop_on_failure, priority)
+    batches[batch.batch_id] = batch
+    # Keep a reference so the task isn't garbage collected
+    batch._task = asyncio.get_running_loop().create_task(batch.run())
+    return batch
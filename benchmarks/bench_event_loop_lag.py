@@ -0,0 +1,108 @@
+"""Event-loop lag while M jobs stream output into the database.
+
+Compares doing the job runner's DB work inline on the event loop with
+handing it to the DB writer thread (db.run_db). A ticker task measures how
+late the loop wakes it up; that delay is what every HTTP request in the
+process waits on top of its own work.
+
+    python benchmarks/bench_event_loop_lag.py --jobs 20 --lines 2000
+
+Prints one JSON object per mode.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+
+from db import Job, SessionLocal, run_db  # noqa: E402
+from executors import spawn_detached  # noqa: E402
+from log_store import JobLogWriter  # noqa: E402
+from process_output import tail_output  # noqa: E402
+
+RUN_DIR = tempfile.mkdtemp()
+
+
+CHILD = "import sys, time\nfor i in range({lines}):\n    print(f'line {{i}} ' + 'x' * 80, flush=True)\n    if i % 50 == 0: time.sleep(0.001)\n"
+
+
+async def run_job(lines: int, inline: bool, flush_bytes: int):
+    job_id = str(uuid.uuid4())
+    with SessionLocal() as db:
+        db.add(Job(id=job_id, command="bench", parameters={}, status="pending"))
+        db.commit()
+
+    async def call(fn, *args):
+        if inline:
+            return fn(*args)
+        return await run_db(fn, *args)
+
+    writer = await call(JobLogWriter, job_id)
+    writer.flush_bytes = flush_bytes
+    await call(writer.set_status, "running")
+    # Started and read the way deployments are, through the detached wrapper's log files
+    run = await spawn_detached([sys.executable, "-c", CHILD.format(lines=lines)], os.path.join(RUN_DIR, job_id))
+    try:
+        async for event, _ in tail_output(run.files.outputs(), finished=lambda: not run.alive()):
+            writer.write(event.source, event.line)
+            if writer.flush_due:
+                await call(writer.flush)
+        return_code = await run.wait()
+    finally:
+        run.release()
+        run.files.remove()
+    await call(writer.set_status, "completed", return_code)
+
+
+async def measure(jobs: int, lines: int, inline: bool, flush_bytes: int, tick: float = 0.005) -> dict:
+    lags = []
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(tick)
+            lags.append((time.perf_counter() - start - tick) * 1000)
+
+    ticker_task = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    await asyncio.gather(*(run_job(lines, inline, flush_bytes) for _ in range(jobs)))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await ticker_task
+
+    lags.sort()
+    return {
+        "mode": "inline" if inline else "writer_thread",
+        "jobs": jobs,
+        "lines_per_job": lines,
+        "flush_bytes": flush_bytes,
+        "elapsed_s": round(elapsed, 3),
+        "lag_ms_p50": round(statistics.median(lags), 3),
+        "lag_ms_p99": round(lags[int(len(lags) * 0.99) - 1], 3),
+        "lag_ms_max": round(lags[-1], 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--lines", type=int, default=2000)
+    parser.add_argument("--flush-bytes", type=int, default=64 * 1024)
+    args = parser.parse_args()
+
+    from migrate import migrate
+    migrate()
+    for inline in (True, False):
+        print(json.dumps(asyncio.run(measure(args.jobs, args.lines, inline, args.flush_bytes))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Per-line cost of phase detection as the marker table grows.
+
+Feeds a synthetic nkp transcript (mostly controller noise, a few phase
+lines) through the progress engine with the real NKP marker table padded
+out with made-up markers, and through the naive alternative of one
+unanchored alternation of all phrases, for comparison.
+
+    python benchmarks/bench_progress.py --lines 200000 --sizes 11,64,256,1024
+
+Prints one JSON object per (matcher, table size).
+"""
+import argparse
+import json
+import os
+import random
+import re
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from progress import NKP_PHASE_MARKERS, PhaseMarker, ProgressEngine  # noqa: E402
+
+
+NOISE = [
+    "I1018 12:00:01.123456   1234 machine.go:312] \"Waiting for machine\" machine=\"default/cl-md-0-abcde\"\n",
+    "  • Waiting for cluster infrastructure to be ready ...\n",
+    "\x1b[32m ✓\x1b[0m Upgrading CAPI components\n",
+    "clusterclass.cluster.x-k8s.io/nkp-nutanix-v2.12.0 created\n",
+    "Warning: spec.template.spec.containers[0].resources: memory limit not set\n",
+]
+
+
+def markers(size: int):
+    rng = random.Random(size)
+    table = list(NKP_PHASE_MARKERS)
+    while len(table) < size:
+        words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9))) for _ in range(4)]
+        table.append(PhaseMarker("extra", " ".join(["Waiting", "for"] + words), 1))
+    return table
+
+
+def transcript(lines: int):
+    rng = random.Random(0)
+    phases = [f" ✓ {marker.phrase}\n" for marker in NKP_PHASE_MARKERS]
+    return [rng.choice(phases) if rng.random() < 0.01 else rng.choice(NOISE) for _ in range(lines)]
+
+
+def naive(table):
+    pattern = re.compile("|".join(re.escape(marker.phrase) for marker in table))
+    by_phrase = {marker.phrase: marker for marker in table}
+    return lambda line: by_phrase.get(match.group(0)) if (match := pattern.search(line)) else None
+
+
+def measure(name: str, match, lines) -> dict:
+    start = time.perf_counter()
+    hits = sum(1 for line in lines if match(line) is not None)
+    elapsed = time.perf_counter() - start
+    return {"matcher": name, "lines": len(lines), "hits": hits, "ns_per_line": round(elapsed / len(lines) * 1e9, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=200000)
+    parser.add_argument("--sizes", default="11,64,256,1024")
+    args = parser.parse_args()
+
+    lines = transcript(args.lines)
+    for size in (int(size) for size in args.sizes.split(",")):
+        table = markers(size)
+        for name, match in (("engine", ProgressEngine(table).match), ("naive_alternation", naive(table))):
+            print(json.dumps({"markers": len(table), **measure(name, match, lines)}))
+
+
+if __name__ == "__main__":
+    main()
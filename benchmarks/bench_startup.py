@@ -0,0 +1,82 @@
+"""Worker startup time: importing each app and serving its first request.
+
+Each sample is a fresh interpreter, like a new uvicorn worker or test run.
+It reports the import of the app module, building the app, and the first
+response of a cheap route through the ASGI interface. The database is a
+temporary SQLite file unless DATABASE_URL is set. Runs happen in a scratch
+working directory, with an empty static/ for trees that still need one there.
+
+    python benchmarks/bench_startup.py --runs 10
+    python benchmarks/bench_startup.py --root /path/to/other/checkout
+
+Prints one JSON object per app module, in milliseconds.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+CHILD = """
+import asyncio, json, sys, time
+import httpx  # the harness's own client, not part of the app's startup
+started = time.perf_counter()
+sys.path.insert(0, {root!r})
+import {module} as module
+imported = time.perf_counter()
+app = module.create_app() if hasattr(module, "create_app") else module.app
+built = time.perf_counter()
+
+async def first_request():
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        response = await client.get({path!r})
+        assert response.status_code == 200, response.status_code
+
+asyncio.run(first_request())
+served = time.perf_counter()
+print(json.dumps({{"import": imported - started, "build": built - imported, "first_request": served - built}}))
+"""
+
+APPS = (("app", "/metrics"), ("ref", "/api/queue"))
+
+
+def sample(root: str, module: str, path: str, workdir: str) -> dict:
+    started = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD.format(root=os.path.abspath(root), module=module, path=path)],
+        cwd=workdir, capture_output=True, text=True, check=True,
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["process"] = time.perf_counter() - started
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--root", default=ROOT, help="checkout to measure")
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="nkp-startup-")
+    os.makedirs(os.path.join(workdir, "static"), exist_ok=True)
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{workdir}/bench.db")
+    for module, path in APPS:
+        # The first run warms the OS file cache and .pyc files
+        sample(args.root, module, path, workdir)
+        runs = [sample(args.root, module, path, workdir) for _ in range(args.runs)]
+        result = {"module": module, "runs": args.runs}
+        for key in ("import", "build", "first_request", "process"):
+            values = [run[key] * 1000 for run in runs]
+            result[f"{key}_ms_median"] = round(statistics.median(values), 1)
+            result[f"{key}_ms_min"] = round(min(values), 1)
+        print(json.dumps(result), flush=True)
+
+
+if __name__ == "__main__":
+    main()
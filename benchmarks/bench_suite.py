@@ -0,0 +1,265 @@
+"""End-to-end benchmarks of the streaming, persistence and status hot paths.
+
+Runs offline: nkp is replaced by the transcript simulator (executors) and
+the database is a temporary SQLite file unless DATABASE_URL points at a
+Postgres stand-in. Everything runs in a scratch working directory.
+
+    python benchmarks/bench_suite.py
+    python benchmarks/bench_suite.py --only sse,status --jobs 8 --viewers 16
+
+Prints one JSON object per benchmark, so runs can be diffed for regressions:
+
+    command_creation  handle_command_creation calls per second
+    sse               app.py stream throughput, event latency and writes, M jobs x N viewers,
+                      optionally batched (--window-ms) and compressed (--encoding)
+    db_writes         run_cli_command DB bytes per output line and memory per job
+    status            /api/status latency as a job's log grows
+"""
+import argparse
+import asyncio
+import json
+import os
+import shlex
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+import zlib
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix="nkp-bench-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{WORKDIR}/bench.db")
+# ref.py mounts ./static; deployments and archives are written relative too
+os.makedirs(os.path.join(WORKDIR, "static"), exist_ok=True)
+os.chdir(WORKDIR)
+
+import executors  # noqa: E402
+from executors import SimulatorExecutor, SimulatorOptions, Transcript, TranscriptLine  # noqa: E402
+
+
+def command_json_deployments():
+    """The valid command shapes in command.json, as /deploy/management bodies."""
+    from nkp_command import InvalidFlags, validate_flags
+
+    with open(os.path.join(ROOT, "command.json"), encoding="utf-8") as f:
+        commands = [block for block in f.read().split("\n\n") if block.strip()]
+    deployments = []
+    for command in commands:
+        argv = shlex.split(command.replace("\\\n", " "))
+        deployment, index = {}, 4
+        while index < len(argv):
+            name, equals, value = argv[index][2:].partition("=")
+            if not equals and index + 1 < len(argv) and not argv[index + 1].startswith("--"):
+                value, index = argv[index + 1], index + 1
+            if name not in ("insecure", "self-managed"):
+                deployment[name] = value
+            index += 1
+        try:
+            validate_flags(deployment)
+        except InvalidFlags:
+            continue
+        deployments.append(deployment)
+    return deployments
+
+
+def transcript(lines: int, line_bytes: int = 100) -> Transcript:
+    body = "x" * (line_bytes - 12)
+    return Transcript([TranscriptLine(0.0, "stdout" if i % 10 else "stderr", f"{i:010d} {body}\n")
+                       for i in range(lines)])
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(int(q * len(samples)), len(samples) - 1)] if samples else None
+
+
+def bench_command_creation(iterations: int) -> dict:
+    from app import handle_command_creation
+
+    deployments = command_json_deployments()
+    start = time.perf_counter()
+    for i in range(iterations):
+        handle_command_creation(deployments[i % len(deployments)])
+    elapsed = time.perf_counter() - start
+    return {"benchmark": "command_creation", "shapes": len(deployments), "calls": iterations,
+            "calls_per_s": round(iterations / elapsed), "us_per_call": round(elapsed / iterations * 1e6, 2)}
+
+
+async def bench_sse(jobs: int, viewers: int, lines: int, window_ms: int = 0, encoding: str = "") -> dict:
+    import app
+    from deployments import start_run
+    from sse import ENCODINGS
+
+    executors.use_executor(SimulatorExecutor(transcript(lines), SimulatorOptions(time_scale=0)))
+    latencies = []
+    received = writes = sent = 0
+
+    async def view(job_id: str):
+        nonlocal received, writes, sent
+        response = app.stream_run(job_id, window_ms=window_ms, accept_encoding=encoding or None)
+        decompressor = zlib.decompressobj(ENCODINGS[encoding]) if encoding else None
+        async for chunk in response.body_iterator:
+            writes += 1
+            sent += len(chunk)
+            text = decompressor.decompress(chunk).decode("utf-8") if decompressor else chunk
+            for line in text.splitlines():
+                if line.startswith("data: {"):
+                    event = json.loads(line[6:])
+                    if event["source"] != "system":
+                        # A batched event holds several lines, its timestamp is the newest one's
+                        latencies.append((time.time() - event["timestamp"]) * 1000)
+                        received += event["line"].count("\n")
+
+    start = time.perf_counter()
+    runs = [start_run(["nkp", "create", "cluster", "nutanix"]) for _ in range(jobs)]
+    await asyncio.gather(*(view(run.job_id) for run in runs for _ in range(viewers)))
+    elapsed = time.perf_counter() - start
+    return {
+        "benchmark": "sse", "jobs": jobs, "viewers_per_job": viewers, "lines_per_job": lines,
+        "window_ms": window_ms, "encoding": encoding or "identity",
+        "elapsed_s": round(elapsed, 3),
+        "lines_per_s": round(jobs * lines / elapsed),
+        "lines_delivered_per_s": round(received / elapsed),
+        "writes_per_viewer": round(writes / (jobs * viewers)),
+        "bytes_per_line": round(sent / max(received, 1), 1),
+        "latency_ms_p50": round(percentile(latencies, 0.5), 3),
+        "latency_ms_p99": round(percentile(latencies, 0.99), 3),
+    }
+
+
+async def bench_db_writes(jobs: int, lines: int, line_bytes: int = 100) -> dict:
+    from sqlalchemy import event
+
+    import ref
+    from db import Job, SessionLocal, engine
+
+    executors.use_executor(SimulatorExecutor(transcript(lines, line_bytes), SimulatorOptions(time_scale=0)))
+    job_ids = [str(uuid.uuid4()) for _ in range(jobs)]
+    with SessionLocal() as db:
+        db.add_all(Job(id=job_id, command="nkp create cluster nutanix", parameters={}, status="pending")
+                   for job_id in job_ids)
+        db.commit()
+
+    sent = {"bytes": 0, "statements": 0}
+
+    def text_bytes(value) -> int:
+        # executemany parameters nest rows; insertmanyvalues batches flatten them
+        if isinstance(value, str):
+            return len(value.encode("utf-8"))
+        if isinstance(value, bytes):
+            return len(value)
+        if isinstance(value, dict):
+            value = value.values()
+        if isinstance(value, (list, tuple, type({}.values()))):
+            return sum(text_bytes(item) for item in value)
+        return 0
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        sent["bytes"] += text_bytes(parameters)
+        sent["statements"] += 1
+
+    db_path = engine.url.database if engine.dialect.name == "sqlite" else None
+    size_before = os.path.getsize(db_path) if db_path else None
+    event.listen(engine, "before_cursor_execute", count)
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(ref.run_cli_command(job_id, "nkp create cluster nutanix") for job_id in job_ids))
+    finally:
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        event.remove(engine, "before_cursor_execute", count)
+
+    with SessionLocal() as db:
+        completed = db.query(Job).filter(Job.id.in_(job_ids), Job.status == "completed").count()
+    total_lines = jobs * lines
+    result = {
+        "benchmark": "db_writes", "jobs": jobs, "lines_per_job": lines, "line_bytes": line_bytes,
+        "completed_jobs": completed, "elapsed_s": round(elapsed, 3),
+        "lines_per_s": round(total_lines / elapsed),
+        "statements_per_1k_lines": round(sent["statements"] / total_lines * 1000, 2),
+        "param_bytes_per_line": round(sent["bytes"] / total_lines, 1),
+        "peak_memory_kib_per_job": round(peak / jobs / 1024, 1),
+    }
+    if db_path:
+        # Includes the archive step's deletes, so this is the net growth
+        result["sqlite_file_bytes_per_line"] = round((os.path.getsize(db_path) - size_before) / total_lines, 1)
+    return result
+
+
+async def bench_status(sizes, requests: int) -> dict:
+    import httpx
+
+    import ref
+    from db import Job, SessionLocal
+    from log_store import JobLogWriter
+
+    results = []
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=ref.app), base_url="http://bench") as client:
+        for size in sizes:
+            job_id = str(uuid.uuid4())
+            with SessionLocal() as db:
+                db.add(Job(id=job_id, command="nkp", parameters={}, status="running"))
+                db.commit()
+            writer = JobLogWriter(job_id)
+            for i in range(size):
+                writer.write("stdout", f"{i:010d} {'x' * 88}\n")
+                if writer.flush_due:
+                    writer.flush()
+            writer.flush()
+            end = (await client.get(f"/api/status/{job_id}", params={"fields": "stdout"})).json()["stdout_offset"]
+
+            row = {"log_lines": size}
+            for name, params in (("full", {}),
+                                 ("no_logs", {"fields": "status,progress"}),
+                                 ("tail_delta", {"fields": "stdout", "stdout_offset": end})):
+                timings = []
+                for _ in range(requests):
+                    start = time.perf_counter()
+                    response = await client.get(f"/api/status/{job_id}", params=params)
+                    timings.append((time.perf_counter() - start) * 1000)
+                    response.raise_for_status()
+                row[f"{name}_ms_p50"] = round(percentile(timings, 0.5), 3)
+                row[f"{name}_ms_p99"] = round(percentile(timings, 0.99), 3)
+            results.append(row)
+    return {"benchmark": "status", "requests": requests, "results": results}
+
+
+BENCHMARKS = ("command_creation", "sse", "db_writes", "status")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--only", default=",".join(BENCHMARKS), help="comma separated subset")
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--viewers", type=int, default=8)
+    parser.add_argument("--lines", type=int, default=5000)
+    parser.add_argument("--window-ms", type=int, default=0, help="sse: batching window, 0 for one event per line")
+    parser.add_argument("--encoding", default="", choices=("", "gzip", "deflate"), help="sse: stream compression")
+    parser.add_argument("--status-sizes", default="1000,10000,50000")
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+
+    from db import engine
+    from migrate import migrate
+    migrate()
+    for name in args.only.split(","):
+        if name == "command_creation":
+            result = bench_command_creation(args.iterations)
+        elif name == "sse":
+            result = asyncio.run(bench_sse(args.jobs, args.viewers, args.lines, args.window_ms, args.encoding))
+        elif name == "db_writes":
+            result = asyncio.run(bench_db_writes(args.jobs, args.lines))
+        elif name == "status":
+            result = asyncio.run(bench_status([int(size) for size in args.status_sizes.split(",")], args.requests))
+        else:
+            parser.error(f"unknown benchmark {name!r}, expected one of {', '.join(BENCHMARKS)}")
+        print(json.dumps({"database": engine.dialect.name, **result}), flush=True)
+
+
+if __name__ == "__main__":
+    main()
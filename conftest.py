@@ -0,0 +1,36 @@
+# conftest.py
+import os
+import tempfile
+import uuid
+
+import pytest
+
+# Before anything builds the engine, and never whatever DATABASE_URL the shell has
+os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/test.db"
+os.environ["NKP_EVENT_BUS"] = "local"
+
+from db import Job, SessionLocal  # noqa: E402
+from migrate import migrate  # noqa: E402
+
+
+@pytest.fixture(scope="session", autouse=True)
+def schema():
+    migrate()
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    # Logs, archives and run files are written relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def make_job():
+    def make_job(**values) -> str:
+        job_id = str(uuid.uuid4())
+        with SessionLocal() as db:
+            db.add(Job(id=job_id, command="nkp create cluster", parameters={}, **{"status": "running", **values}))
+            db.commit()
+        return job_id
+    return make_job
@@ -0,0 +1,575 @@
+# deployments.py
+import asyncio
+import fcntl
+import glob
+import json
+import os
+import time
+import uuid
+from datetime import datetime
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from detached import DetachedRun, RunFiles
+from event_bus import event_bus
+from executors import spawn_detached
+from fanout import OverflowPolicy, RingBuffer, Subscriber
+from log_archive import LogArchiveWriter
+from metrics import jobs_total, observe_deployment, queue_depth, running_deployments
+from nkp_command import display_command, flag_value, spec_hash
+from process_output import OutputEvent, tail_output
+from progress import progress_engine
+from scheduler import DeploymentScheduler
+
+
+# Where each run's events are persisted, one JSON object per line
+DEPLOYMENT_LOG_DIR = "deployments"
+# How long a finished run stays in memory before replay falls back to disk
+FINISHED_RUN_RETENTION = 3600
+# Events kept in memory per run, older ones are replayed from disk
+RING_BUFFER_SIZE = 10000
+# Events queued per viewer before its overflow policy kicks in
+SUBSCRIBER_QUEUE_SIZE = 1000
+DEFAULT_OVERFLOW_POLICY = OverflowPolicy.DROP_OLDEST
+# How often a viewer following another worker's run checks whether it ended
+REMOTE_POLL_INTERVAL = 5.0
+# Deployment concurrency limits, overall and per Prism Central endpoint
+MAX_CONCURRENT_DEPLOYMENTS = 4
+MAX_DEPLOYMENTS_PER_ENDPOINT = 2
+
+
+def event_log_path(job_id: str) -> str:
+    return os.path.join(DEPLOYMENT_LOG_DIR, f"{job_id}.events.jsonl")
+
+
+def run_base(job_id: str) -> str:
+    """Where the run's detached process keeps its output files, see detached.py."""
+    return os.path.join(DEPLOYMENT_LOG_DIR, job_id)
+
+
+def result_path(job_id: str) -> str:
+    """Written when the run ends, with its return code."""
+    return os.path.join(DEPLOYMENT_LOG_DIR, f"{job_id}.result.json")
+
+
+def queued_path(job_id: str) -> str:
+    """What a queued run is started with, held locked by the worker that queued it."""
+    return os.path.join(DEPLOYMENT_LOG_DIR, f"{job_id}.queued.json")
+
+
+def _hold_queued(job_id: str, info: Optional[dict] = None):
+    """Lock the run's queued file, writing ``info`` to it; None if another worker holds it.
+
+    The lock goes away with the worker, so after a restart the runs it had
+    queued can be told from those another worker still has.
+    """
+    os.makedirs(DEPLOYMENT_LOG_DIR, exist_ok=True)
+    try:
+        # Only created when there's something to write to it
+        f = open(queued_path(job_id), "a+" if info is not None else "r+", encoding="utf-8")
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    if info is not None:
+        f.truncate(0)
+        f.write(json.dumps(info))
+        f.flush()
+    return f
+
+
+def output_log_path(job_id: str) -> str:
+    """The run's stdout and stderr as a terminal shows them, see log_archive."""
+    return os.path.join(DEPLOYMENT_LOG_DIR, f"{job_id}.output")
+
+
+def run_status(return_code: Optional[int]) -> str:
+    """Status of a run that has ended, as ref.py reports jobs."""
+    return "completed" if return_code == 0 else "failed"
+
+
+class DeploymentRun:
+    """A single ``nkp create cluster`` process and the events it produced.
+
+    The process is read by its own task that never waits on HTTP clients.
+    Every event gets a monotonically increasing id, is appended to the job's
+    event log on disk and to a ring buffer of recent events, then pushed to
+    each viewer's bounded queue.
+
+    nkp runs detached with its output in files (see detached.py), and each
+    output event is logged with its offset in those files. After a restart
+    ``reattach`` rebuilds the run from its event log and reads on from there.
+    """
+
+    def __init__(self, job_id: str, argv: List[str]):
+        self.job_id = job_id
+        self.argv = argv
+        # For display, with secrets masked
+        self.command = display_command(argv)
+        # A repeated request, by key or by spec, gets this run instead of a new one
+        self.cluster_name = flag_value(argv, "cluster-name")
+        self.spec_hash = spec_hash(argv)
+        self.idempotency_key: Optional[str] = None
+        self.events: RingBuffer[OutputEvent] = RingBuffer(RING_BUFFER_SIZE)
+        self.subscribers: Set[Subscriber] = set()
+        self.return_code: Optional[int] = None
+        self.started = False
+        self.done = False
+        self.phases = progress_engine.tracker()
+        self.detached: Optional[DetachedRun] = None
+        # Called with each (id, event) as it's appended, e.g. by a batch
+        self.listeners: List[Callable[[int, OutputEvent], None]] = []
+        self._finished = asyncio.Event()
+        # Read so far from each of the process's output files
+        self._offsets: Dict[str, int] = {}
+        # The locked queued file, until the process is started
+        self._queued = None
+
+        os.makedirs(DEPLOYMENT_LOG_DIR, exist_ok=True)
+        self._log = open(event_log_path(job_id), "a", encoding="utf-8")
+
+    @classmethod
+    def reattach(cls, job_id: str) -> Optional["DeploymentRun"]:
+        """The run of ``job_id`` as its files left it, None if another worker has it."""
+        detached = DetachedRun.attach(run_base(job_id))
+        if not detached.claim():
+            return None
+        # Before the log is reopened, or the next event would be appended to the cut off one
+        _drop_partial_line(event_log_path(job_id))
+        run = cls(job_id, detached.argv)
+        run.detached = detached
+        run.started = True
+        run._load_events()
+        return run
+
+    @classmethod
+    def requeue(cls, job_id: str) -> Optional[Tuple["DeploymentRun", dict]]:
+        """The run of ``job_id`` that was still queued, with how it was queued.
+
+        None if another worker has it queued, or it was started meanwhile.
+        """
+        queued = _hold_queued(job_id)
+        if queued is None:
+            return None
+        queued.seek(0)
+        try:
+            info = json.load(queued)
+        except ValueError:
+            # Still being written by the worker queuing it
+            info = None
+        if info is None or os.path.exists(RunFiles(run_base(job_id)).process) or os.path.exists(result_path(job_id)):
+            queued.close()
+            return None
+        _drop_partial_line(event_log_path(job_id))
+        run = cls(job_id, info["argv"])
+        run._queued = queued
+        run._load_events()
+        return run, info
+
+    def _load_events(self):
+        for event_id, event, offset in _read_event_log(self.job_id):
+            self.events.append(event)
+            if offset is not None:
+                self._offsets[event.source] = offset
+                self.phases.feed(event.line, datetime.fromtimestamp(event.timestamp))
+
+    def _dequeued(self):
+        """The run is no longer queued, its process files (or result) say what became of it."""
+        if self._queued is not None:
+            os.remove(queued_path(self.job_id))
+            self._queued.close()
+            self._queued = None
+
+    async def run(self):
+        self.started = True
+        started = time.time()
+        output = LogArchiveWriter(output_log_path(self.job_id))
+        try:
+            if self.detached is None:
+                jobs_total.labels("running").inc()
+                # Exec'd directly (or simulated, see executors), no shell in between
+                self.detached = await spawn_detached(self.argv, run_base(self.job_id))
+                self._dequeued()
+                self._append(OutputEvent("system", f"Command started: {self.command}", time.time()))
+            else:
+                started = self.detached.started_at or started
+                # The output archive is rewritten from the start
+                for _, event, offset in _read_event_log(self.job_id):
+                    if offset is not None:
+                        output.write(event.line)
+                self._append(OutputEvent("system", "Reattached after a server restart", time.time()))
+            detached = self.detached
+
+            async for event, offset in tail_output(detached.files.outputs(), self._offsets,
+                                                   finished=lambda: not detached.alive()):
+                self._append(event, offset)
+                output.write(event.line)
+                if self.phases.feed(event.line) is not None:
+                    self._append(OutputEvent("system", f"Phase: {self.phases.phase} ({self.phases.progress}%)", time.time()))
+
+            self.return_code = await detached.wait()
+            if self.return_code is None:
+                self._append(OutputEvent("system", "nkp stopped while the server was down and left no exit code", time.time()))
+                self.return_code = -1
+            self._append(OutputEvent("system", f"Command completed with return code: {self.return_code}", time.time()))
+            output.close()
+            self._append(OutputEvent("system", f"Output saved to {output.data_path}", time.time()))
+        except Exception as e:
+            self._append(OutputEvent("system", f"Exception occurred: {str(e)}", time.time()))
+            if self.detached is not None:
+                # Nothing is following it anymore
+                self.detached.terminate()
+        finally:
+            output.close()
+            self.phases.finish()
+            status = run_status(self.return_code)
+            jobs_total.labels(status).inc()
+            observe_deployment(status, time.time() - started, self.phases.durations())
+            self._log.close()
+            self._save_result()
+            self._dequeued()
+            if self.detached is not None:
+                # Its output is in the event log and the archive now
+                self.detached.release()
+                self.detached.files.remove()
+            self.done = True
+            self._finished.set()
+            for subscriber in self.subscribers:
+                subscriber.close()
+            asyncio.get_running_loop().call_later(FINISHED_RUN_RETENTION, runs.pop, self.job_id, None)
+
+    async def wait(self) -> Optional[int]:
+        """Wait for the run to end and return its return code."""
+        await self._finished.wait()
+        return self.return_code
+
+    def status(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "status": run_status(self.return_code) if self.done else "running" if self.started else "pending",
+            "return_code": self.return_code,
+            "phase": self.phases.phase,
+            "progress": 100 if self.return_code == 0 else self.phases.progress,
+            "phase_timeline": self.phases.timeline,
+            "queue_position": scheduler.position(self.job_id),
+            "queued_seconds": scheduler.queued_seconds(self.job_id),
+            "last_event_id": self.events.last_id,
+        }
+
+    def _append(self, event: OutputEvent, offset: Optional[int] = None):
+        entry = self.events.append(event)
+        record = {"id": entry[0], **event.to_dict()}
+        if offset is not None:
+            # Where reading resumes after a restart
+            record["offset"] = offset
+        self._log.write(json.dumps(record) + "\n")
+        self._log.flush()
+        for subscriber in self.subscribers:
+            subscriber.push(entry)
+        for listener in self.listeners:
+            listener(*entry)
+        if event_bus.cross_process:
+            # For viewers on other workers, after it is in the log they catch up from
+            event_bus.publish(f"deployment:{self.job_id}", {"id": entry[0], **event.to_dict()}, strip=("line",))
+
+    def _save_result(self):
+        path = result_path(self.job_id)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump({"return_code": self.return_code, "phase": self.phases.phase,
+                       "progress": 100 if self.return_code == 0 else self.phases.progress,
+                       "phase_timeline": self.phases.timeline, "last_event_id": self.events.last_id}, f)
+        os.replace(f"{path}.tmp", path)
+        if event_bus.cross_process:
+            event_bus.publish(f"deployment:{self.job_id}", {"done": True})
+
+    async def follow(self, last_event_id: int = 0,
+                     policy: OverflowPolicy = DEFAULT_OVERFLOW_POLICY) -> AsyncIterator[Tuple[int, OutputEvent]]:
+        """Yield events after ``last_event_id``, then the live tail until the run ends.
+
+        Raises SubscriberOverflow if the viewer falls behind under the
+        DISCONNECT policy; it can resume from the last id it received.
+        """
+        # Nothing below awaits until the subscriber is registered, so no event
+        # can slip between the backlog and the live queue
+        backlog = []
+        if last_event_id + 1 < self.events.first_id:
+            backlog = replay_from_log(self.job_id, last_event_id, before=self.events.first_id) or []
+        backlog += self.events.since(last_event_id)
+        subscriber = None
+        if not self.done:
+            subscriber = Subscriber(SUBSCRIBER_QUEUE_SIZE, policy, coalesce=coalesce_events)
+            self.subscribers.add(subscriber)
+        try:
+            for entry in backlog:
+                yield entry
+            if subscriber is not None:
+                async for entry in subscriber:
+                    yield entry
+        finally:
+            if subscriber is not None:
+                self.subscribers.discard(subscriber)
+
+
+def coalesce_events(queued: Tuple[int, OutputEvent], new: Tuple[int, OutputEvent]) -> Optional[Tuple[int, OutputEvent]]:
+    """Merge consecutive output from the same source into one event."""
+    (_, older), (new_id, newer) = queued, new
+    # System messages have no newline of their own and would run together
+    if older.source != newer.source or not older.line.endswith("\n"):
+        return None
+    return new_id, OutputEvent(newer.source, older.line + newer.line, newer.timestamp)
+
+
+# Runs started by this process, by job id
+runs: Dict[str, DeploymentRun] = {}
+scheduler = DeploymentScheduler(MAX_CONCURRENT_DEPLOYMENTS, MAX_DEPLOYMENTS_PER_ENDPOINT)
+queue_depth.set_function(lambda: scheduler.stats()["queued"])
+running_deployments.set_function(lambda: scheduler.stats()["running"])
+
+
+def start_run(argv: List[str], endpoint: Optional[str] = None, priority: int = 0) -> DeploymentRun:
+    """Queue a deployment; it starts once a slot for its endpoint is free."""
+    job_id, enqueued_at = str(uuid.uuid4()), time.time()
+    # Saved before the event log exists, so a restarting worker never finds the log alone
+    queued = _hold_queued(job_id, {"argv": argv, "endpoint": endpoint, "priority": priority,
+                                   "enqueued_at": enqueued_at})
+    run = DeploymentRun(job_id, argv)
+    run._queued = queued
+    runs[run.job_id] = run
+    jobs_total.labels("pending").inc()
+    position = scheduler.submit(run.job_id, run.run, endpoint=endpoint, priority=priority, enqueued_at=enqueued_at)
+    run._append(OutputEvent("system", f"Queued for deployment, position {position}", time.time()))
+    return run
+
+
+def load_result(job_id: str) -> Optional[dict]:
+    try:
+        with open(result_path(job_id), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def remote_status(job_id: str) -> Optional[dict]:
+    """DeploymentRun.status() of a run this process isn't running, from its files."""
+    if not os.path.exists(event_log_path(job_id)):
+        return None
+    result = load_result(job_id)
+    if result is None:
+        phases = progress_engine.tracker()
+        last_event_id = 0
+        for event_id, event, offset in _read_event_log(job_id):
+            last_event_id = event_id
+            if offset is not None:
+                phases.feed(event.line, datetime.fromtimestamp(event.timestamp))
+        result = {"return_code": None, "phase": phases.phase, "progress": phases.progress,
+                  "phase_timeline": phases.timeline, "last_event_id": last_event_id}
+    return {
+        "job_id": job_id,
+        # Where a queued run is in the queue is only known to the worker that queued it
+        "status": run_status(result["return_code"]) if result["return_code"] is not None
+        else "pending" if os.path.exists(queued_path(job_id)) else "running",
+        **result,
+        "queue_position": None,
+        "queued_seconds": None,
+    }
+
+
+async def follow_remote(job_id: str, last_event_id: int = 0) -> AsyncIterator[Tuple[int, OutputEvent]]:
+    """Events of a run another worker has, like DeploymentRun.follow.
+
+    Persisted events come from the event log, live ones from the event bus.
+    Whenever the bus skips an event, or sends one without its line, the
+    rest is read from the log again, which has everything the bus sent.
+    """
+    subscriber = Subscriber(SUBSCRIBER_QUEUE_SIZE, OverflowPolicy.DROP_OLDEST)
+    key = f"deployment:{job_id}"
+    # Subscribed before reading the log so nothing falls in between
+    event_bus.subscribe(key, subscriber.push)
+    last_id = last_event_id
+
+    def catch_up() -> List[Tuple[int, OutputEvent]]:
+        nonlocal last_id
+        events = replay_from_log(job_id, last_id) or []
+        if events:
+            last_id = events[-1][0]
+        return events
+
+    try:
+        for entry in catch_up():
+            yield entry
+        while load_result(job_id) is None:
+            try:
+                message = await asyncio.wait_for(subscriber.__anext__(), timeout=REMOTE_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                # Messages can be lost, the result file can't
+                continue
+            if message.get("done"):
+                break
+            if message["id"] <= last_id:
+                continue
+            if message["id"] == last_id + 1 and "line" in message:
+                # The message is shared with every other subscriber, left as it is
+                last_id = message["id"]
+                yield last_id, OutputEvent(**{name: value for name, value in message.items() if name != "id"})
+            else:
+                for entry in catch_up():
+                    yield entry
+        for entry in catch_up():
+            yield entry
+    finally:
+        event_bus.unsubscribe(key, subscriber.push)
+
+
+def reattach_runs() -> List[DeploymentRun]:
+    """Pick up the runs that were running or queued when the server stopped.
+
+    A run's process files are removed when it finishes, so any left over
+    belong to one that was still being followed. Each is adopted by the
+    scheduler and read on from where its event log ends. Runs that hadn't
+    started yet are queued again, as they were queued before.
+
+    A run has queued or process files until its result is saved, so an
+    event log with none of them belongs to a run that was lost some other
+    way; it is ended as failed, so its status and viewers don't wait on it
+    forever.
+    """
+    reattached = []
+    for path in glob.glob(os.path.join(DEPLOYMENT_LOG_DIR, "*.process.json")):
+        job_id = os.path.basename(path)[:-len(".process.json")]
+        if job_id in runs:
+            continue
+        run = DeploymentRun.reattach(job_id)
+        if run is None:
+            continue
+        runs[job_id] = run
+        scheduler.adopt(job_id, run.run)
+        reattached.append(run)
+    for path in glob.glob(os.path.join(DEPLOYMENT_LOG_DIR, "*.queued.json")):
+        job_id = os.path.basename(path)[:-len(".queued.json")]
+        if job_id in runs:
+            continue
+        requeued = DeploymentRun.requeue(job_id)
+        if requeued is None:
+            continue
+        run, info = requeued
+        runs[job_id] = run
+        position = scheduler.submit(job_id, run.run, endpoint=info["endpoint"], priority=info["priority"],
+                                    enqueued_at=info["enqueued_at"])
+        run._append(OutputEvent("system", f"Queued again after a server restart, position {position}", time.time()))
+        reattached.append(run)
+    for path in glob.glob(os.path.join(DEPLOYMENT_LOG_DIR, "*.events.jsonl")):
+        job_id = os.path.basename(path)[:-len(".events.jsonl")]
+        if job_id in runs or any(os.path.exists(other) for other in (
+                queued_path(job_id), RunFiles(run_base(job_id)).process, result_path(job_id))):
+            continue
+        _end_lost_run(job_id)
+    return reattached
+
+
+def _end_lost_run(job_id: str):
+    _drop_partial_line(event_log_path(job_id))
+    run = DeploymentRun(job_id, [])
+    run._load_events()
+    run.return_code = -1
+    run._append(OutputEvent("system", "The deployment was lost while the server was down", time.time()))
+    run._log.close()
+    run._save_result()
+
+
+def _read_event_log(job_id: str) -> Iterator[Tuple[int, OutputEvent, Optional[int]]]:
+    # (id, event, offset in its output file); offset is None for system events
+    path = event_log_path(job_id)
+    if not os.path.exists(path):
+        return
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                # Still being written, or cut off by the server being killed mid-append
+                break
+            record = json.loads(line)
+            event_id = record.pop("id")
+            offset = record.pop("offset", None)
+            yield event_id, OutputEvent(**record), offset
+
+
+def _drop_partial_line(path: str, chunk_size: int = 64 * 1024):
+    """Truncate the file after its last newline, if anything follows it."""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        end = position = f.seek(0, os.SEEK_END)
+        while position > 0:
+            start = max(position - chunk_size, 0)
+            f.seek(start)
+            newline = f.read(position - start).rfind(b"\n")
+            if newline != -1:
+                position = start + newline + 1
+                break
+            position = start
+        if position < end:
+            f.truncate(position)
+
+
+class DeploymentConflict(Exception):
+    """The request conflicts with ``run``, e.g. the same cluster with different flags."""
+
+    def __init__(self, message: str, run: DeploymentRun):
+        super().__init__(message)
+        self.run = run
+
+
+class IdempotencyKeyReused(DeploymentConflict):
+    """The Idempotency-Key was already used for ``run``, which has a different spec."""
+
+
+def find_conflict(argv: List[str]) -> Optional[DeploymentRun]:
+    """A pending or running deployment of the same cluster with a different spec."""
+    name, digest = flag_value(argv, "cluster-name"), spec_hash(argv)
+    for run in runs.values():
+        if name is not None and not run.done and run.cluster_name == name and run.spec_hash != digest:
+            return run
+    return None
+
+
+def submit_run(argv: List[str], endpoint: Optional[str] = None, priority: int = 0,
+               idempotency_key: Optional[str] = None) -> Tuple[DeploymentRun, bool]:
+    """start_run, unless the request repeats an earlier one; returns the run and whether it is new.
+
+    A request with the idempotency key of a run still in memory gets that
+    run. So does one with the same spec as a deployment still pending or
+    running, e.g. a double-clicked Deploy. Raises IdempotencyKeyReused for
+    a key reused with a different spec, and DeploymentConflict for a
+    cluster already being deployed with different flags.
+    """
+    digest = spec_hash(argv)
+    if idempotency_key is not None:
+        for run in runs.values():
+            if run.idempotency_key == idempotency_key:
+                if run.spec_hash != digest:
+                    raise IdempotencyKeyReused("Idempotency-Key was already used for a different deployment", run)
+                return run, False
+    name = flag_value(argv, "cluster-name")
+    for run in runs.values():
+        if name is not None and not run.done and run.cluster_name == name:
+            if run.spec_hash != digest:
+                raise DeploymentConflict(f"Cluster {run.cluster_name} is already being deployed with other flags", run)
+            return run, False
+    run = start_run(argv, endpoint, priority)
+    run.idempotency_key = idempotency_key
+    return run, True
+
+
+def replay_from_log(job_id: str, last_event_id: int = 0,
+                    before: Optional[int] = None) -> Optional[List[Tuple[int, OutputEvent]]]:
+    """Read persisted events with ``last_event_id < id < before``."""
+    if not os.path.exists(event_log_path(job_id)):
+        return None
+    events = []
+    for event_id, event, _ in _read_event_log(job_id):
+        if before is not None and event_id >= before:
+            break
+        if event_id > last_event_id:
+            events.append((event_id, event))
+    return events
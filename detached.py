@@ -0,0 +1,219 @@
+# detached.py
+"""Runs nkp so that it outlives the server that started it.
+
+    python detached.py <exit file> -- nkp create cluster ...
+
+is what actually gets started (see executors.spawn_detached). It runs in a
+session of its own, with stdout and stderr already pointed at the run's log
+files, starts the command and, once it exits, records the exit code in
+``<exit file>``. A server restart leaves it running, and the next server
+finds its output and exit code on disk instead of in a pipe that died with
+the old one.
+
+Only the standard library is imported here, the wrapper runs it as a script.
+"""
+import asyncio
+import fcntl
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+
+WRAPPER = os.path.abspath(__file__)
+# How often an adopted run (one we're not the parent of) is checked for exit
+POLL_INTERVAL = 0.5
+# The machine (or container) runs are started on; pids mean nothing on any other
+HOST = os.environ.get("NKP_HOST") or socket.gethostname()
+
+
+@dataclass
+class RunFiles:
+    """Where a detached run keeps its state, all next to ``base``."""
+    base: str
+
+    @property
+    def stdout(self) -> str:
+        return f"{self.base}.stdout.log"
+
+    @property
+    def stderr(self) -> str:
+        return f"{self.base}.stderr.log"
+
+    @property
+    def exit_code(self) -> str:
+        return f"{self.base}.exit"
+
+    @property
+    def process(self) -> str:
+        return f"{self.base}.process.json"
+
+    @property
+    def lock(self) -> str:
+        return f"{self.base}.lock"
+
+    def outputs(self) -> Dict[str, str]:
+        return {"stdout": self.stdout, "stderr": self.stderr}
+
+    def exists(self) -> bool:
+        return os.path.exists(self.process)
+
+    def remove(self):
+        for path in (self.stdout, self.stderr, self.exit_code, self.process, self.lock):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def _replace(path: str, text: str):
+    # Readers see the old file or the whole new one, never half of it
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def write_exit_code(path: str, code: int):
+    _replace(path, str(code))
+
+
+def read_exit_code(path: str) -> Optional[int]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return int(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+class DetachedRun:
+    """A command started in its own session, found again through its files.
+
+    ``process`` is the child object when this server started the run;
+    adopted runs only have the pid and process group from ``process.json``.
+    A run is over once its exit code is on disk, or, if the wrapper was
+    killed before it could write one, once its process is gone.
+
+    The server following a run holds its claim (an flock on ``<base>.lock``),
+    so with several workers only one of them adopts it after a restart. The
+    lock goes away with the process holding it.
+    """
+
+    def __init__(self, files: RunFiles, pid: Optional[int] = None, pgid: Optional[int] = None,
+                 argv: Optional[List[str]] = None, started_at: Optional[float] = None, process=None):
+        self.files = files
+        self.pid = pid
+        self.pgid = pgid
+        self.argv = argv or []
+        self.started_at = started_at
+        self.process = process
+        self._lock_file = None
+
+    @classmethod
+    def attach(cls, base: str) -> "DetachedRun":
+        """The run whose files are at ``base``, as far as they tell."""
+        files = RunFiles(base)
+        try:
+            with open(files.process, encoding="utf-8") as f:
+                info = json.load(f)
+        except (FileNotFoundError, ValueError):
+            info = {}
+        return cls(files, info.get("pid"), info.get("pgid"), info.get("argv"), info.get("started_at"))
+
+    def save(self):
+        """Record the pid and process group, so a later server can adopt the run."""
+        _replace(self.files.process, json.dumps({
+            "pid": self.pid,
+            "pgid": self.pgid,
+            "argv": self.argv,
+            "started_at": self.started_at,
+        }))
+
+    def claim(self) -> bool:
+        """Take the run for this process; False if another one has it."""
+        if self._lock_file is not None:
+            return True
+        os.makedirs(os.path.dirname(self.files.lock) or ".", exist_ok=True)
+        f = open(self.files.lock, "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        self._lock_file = f
+        return True
+
+    def release(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def exit_code(self) -> Optional[int]:
+        code = read_exit_code(self.files.exit_code)
+        if code is None and self.process is not None:
+            return self.process.returncode
+        return code
+
+    def alive(self) -> bool:
+        if os.path.exists(self.files.exit_code):
+            return False
+        if self.process is not None:
+            return self.process.returncode is None
+        if self.pid is None:
+            return False
+        try:
+            os.kill(self.pid, 0)
+            # A reused pid won't be leading the run's process group
+            return os.getpgid(self.pid) == self.pgid
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+
+    async def wait(self) -> Optional[int]:
+        """The exit code once the run is over, None if it died without one."""
+        if self.process is not None:
+            await self.process.wait()
+        else:
+            while self.alive():
+                await asyncio.sleep(POLL_INTERVAL)
+        return self.exit_code()
+
+    def terminate(self):
+        if self.process is not None and self.pid is None:
+            self.process.terminate()
+        elif self.pgid is not None and self.alive():
+            os.killpg(self.pgid, signal.SIGTERM)
+
+
+def main(args: List[str]) -> int:
+    if len(args) < 3 or args[1] != "--":
+        print("usage: detached.py <exit file> -- command [args...]", file=sys.stderr)
+        return 2
+    exit_path, command = args[0], args[2:]
+    child = None
+
+    def forward(signum, frame):
+        # Stay alive to record how the command ended
+        if child is not None:
+            child.send_signal(signum)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    try:
+        child = subprocess.Popen(command, stdin=subprocess.DEVNULL)
+    except OSError as e:
+        print(f"Failed to start {command[0]}: {e}", file=sys.stderr, flush=True)
+        code = 127
+    else:
+        code = child.wait()
+    write_exit_code(exit_path, code)
+    return code if code >= 0 else 128 - code
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,194 @@
+# event_bus.py
+import asyncio
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import uuid
+from typing import Callable, Dict, Iterable, Optional, Set
+
+from db import DEFAULT_DATABASE_URL, get_engine
+
+
+logger = logging.getLogger(__name__)
+
+# Postgres NOTIFY payloads must be shorter than 8000 bytes
+MAX_NOTIFY_BYTES = 7800
+NOTIFY_CHANNEL = "nkp_events"
+# How long the listener waits on its connection before checking for shutdown
+LISTEN_TIMEOUT = 1.0
+# Wait before reconnecting after the listen or notify connection fails
+RECONNECT_DELAY = 2.0
+
+Handler = Callable[[dict], None]
+
+
+class LocalEventBus:
+    """Publishes messages to handlers in this process, keyed by a string
+    like ``job:<id>``.
+
+    Handlers run on the event loop. Messages are plain JSON-serializable
+    dicts; this bus hands them over as they are.
+    """
+
+    cross_process = False
+
+    def __init__(self):
+        self._handlers: Dict[str, Set[Handler]] = {}
+
+    def subscribe(self, key: str, handler: Handler):
+        self._handlers.setdefault(key, set()).add(handler)
+
+    def unsubscribe(self, key: str, handler: Handler):
+        handlers = self._handlers.get(key)
+        if handlers is None:
+            return
+        handlers.discard(handler)
+        if not handlers:
+            del self._handlers[key]
+
+    def publish(self, key: str, message: dict, strip: Iterable[str] = ()):
+        """Deliver ``message`` to ``key``'s handlers.
+
+        ``strip`` names fields that may be left out when the message is too
+        big to send between processes; receivers must cope without them.
+        """
+        self._deliver(key, message)
+
+    def start(self):
+        """Start delivering; call from the loop, e.g. on startup."""
+
+    def stop(self):
+        pass
+
+    def _deliver(self, key: str, message: dict):
+        for handler in list(self._handlers.get(key, ())):
+            handler(message)
+
+
+class PostgresEventBus(LocalEventBus):
+    """A LocalEventBus that also reaches every other worker, through
+    Postgres ``LISTEN``/``NOTIFY`` on the application database.
+
+    Messages are delivered locally straight away, as with LocalEventBus,
+    and sent to the other processes by a sender thread. A listener thread
+    hands their messages to this process's loop. Each thread keeps one
+    connection of its own, taken out of the pool.
+
+    Delivery between processes is best effort: NOTIFY is lost while a
+    connection is down, and messages that don't fit in a payload lose their
+    ``strip`` fields. Everything published here is also stored (in the
+    database or the event log), and subscribers catch up from there.
+    """
+
+    cross_process = True
+
+    def __init__(self, channel: str = NOTIFY_CHANNEL):
+        super().__init__()
+        self.channel = channel
+        # Our own messages come back from Postgres too, they are skipped
+        self.origin = uuid.uuid4().hex
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._outbox: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def publish(self, key: str, message: dict, strip: Iterable[str] = ()):
+        self._deliver(key, message)
+        if self._loop is None:
+            return
+        payload = json.dumps({"origin": self.origin, "key": key, "message": message})
+        if len(payload.encode("utf-8")) > MAX_NOTIFY_BYTES:
+            message = {name: value for name, value in message.items() if name not in strip}
+            payload = json.dumps({"origin": self.origin, "key": key, "message": message})
+            if len(payload.encode("utf-8")) > MAX_NOTIFY_BYTES:
+                logger.warning("Event for %s too large to notify, dropped", key)
+                return
+        self._outbox.put(payload)
+
+    def start(self):
+        if self._loop is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._stopped.clear()
+        self._threads = [
+            threading.Thread(target=self._listen, name="event-bus-listen", daemon=True),
+            threading.Thread(target=self._send, name="event-bus-notify", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._outbox.put(None)
+        self._loop = None
+
+    def _connect(self):
+        # A connection of its own for good, so it never goes back to the pool
+        connection = get_engine().raw_connection()
+        connection.detach()
+        dbapi = connection.driver_connection
+        dbapi.autocommit = True
+        return connection, dbapi
+
+    def _send(self):
+        connection = None
+        while not self._stopped.is_set():
+            payload = self._outbox.get()
+            if payload is None:
+                break
+            try:
+                if connection is None:
+                    connection, dbapi = self._connect()
+                with dbapi.cursor() as cursor:
+                    cursor.execute("SELECT pg_notify(%s, %s)", (self.channel, payload))
+            except Exception:
+                logger.exception("NOTIFY failed, reconnecting")
+                if connection is not None:
+                    connection.invalidate()
+                    connection = None
+                self._stopped.wait(RECONNECT_DELAY)
+        if connection is not None:
+            connection.close()
+
+    def _listen(self):
+        while not self._stopped.is_set():
+            connection = None
+            try:
+                connection, dbapi = self._connect()
+                with dbapi.cursor() as cursor:
+                    cursor.execute(f'LISTEN "{self.channel}"')
+                while not self._stopped.is_set():
+                    if select.select([dbapi], [], [], LISTEN_TIMEOUT) == ([], [], []):
+                        continue
+                    dbapi.poll()
+                    while dbapi.notifies:
+                        self._received(dbapi.notifies.pop(0).payload)
+            except Exception:
+                logger.exception("LISTEN failed, reconnecting")
+                self._stopped.wait(RECONNECT_DELAY)
+            finally:
+                if connection is not None:
+                    connection.invalidate()
+
+    def _received(self, payload: str):
+        envelope = json.loads(payload)
+        if envelope["origin"] == self.origin:
+            return
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._deliver, envelope["key"], envelope["message"])
+
+
+def event_bus_from_env(environ=os.environ) -> LocalEventBus:
+    """NKP_EVENT_BUS=local|postgres; by default postgres when DATABASE_URL is Postgres."""
+    kind = environ.get("NKP_EVENT_BUS", "auto")
+    if kind == "auto":
+        url = environ.get("DATABASE_URL", DEFAULT_DATABASE_URL)
+        kind = "postgres" if url.startswith("postgres") else "local"
+    return PostgresEventBus() if kind == "postgres" else LocalEventBus()
+
+
+event_bus = event_bus_from_env()
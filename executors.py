@@ -0,0 +1,248 @@
+# executors.py
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence
+
+from detached import WRAPPER, DetachedRun, RunFiles, write_exit_code
+from metrics import spawn_latency
+from progress import NKP_PHASE_MARKERS
+
+
+class SubprocessExecutor:
+    """Runs the real command, exec'd without a shell."""
+
+    async def spawn(self, argv: List[str], files: RunFiles) -> asyncio.subprocess.Process:
+        """Start ``argv`` under the detached.py wrapper, in a session of its own."""
+        with open(files.stdout, "wb") as stdout, open(files.stderr, "wb") as stderr:
+            return await asyncio.create_subprocess_exec(
+                sys.executable, WRAPPER, files.exit_code, "--", *argv,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=stdout,
+                stderr=stderr,
+                start_new_session=True,
+            )
+
+
+@dataclass
+class TranscriptLine:
+    delay: float  # seconds after the previous line
+    stream: str  # "stdout" or "stderr"
+    data: str  # as written, a trailing newline is not implied
+
+
+@dataclass
+class Transcript:
+    lines: List[TranscriptLine] = field(default_factory=list)
+    exit_code: int = 0
+
+
+_RETURN_CODE = re.compile(r"Command completed with return code: (-?\d+)")
+
+
+def load_transcript(path: str) -> Transcript:
+    """Read a run's recorded events (deployments/<id>.events.jsonl).
+
+    Output events become transcript lines with their original spacing; the
+    exit code comes from the completion event.
+    """
+    transcript = Transcript()
+    previous = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record["source"] == "system":
+                match = _RETURN_CODE.match(record["line"])
+                if match:
+                    transcript.exit_code = int(match.group(1))
+                continue
+            delay = 0.0 if previous is None else max(record["timestamp"] - previous, 0.0)
+            previous = record["timestamp"]
+            transcript.lines.append(TranscriptLine(delay, record["source"], record["line"]))
+    return transcript
+
+
+def _flag(argv: Sequence[str], name: str, default: int) -> int:
+    for index, arg in enumerate(argv):
+        if arg == f"--{name}" and index + 1 < len(argv):
+            value = argv[index + 1]
+        elif arg.startswith(f"--{name}="):
+            value = arg.split("=", 1)[1]
+        else:
+            continue
+        try:
+            return int(value)
+        except ValueError:
+            return default
+    return default
+
+
+def synthetic_transcript(argv: Sequence[str], seed: int = 0) -> Transcript:
+    """A plausible ``nkp create cluster`` run for ``argv``, for when nothing was recorded.
+
+    Walks the phase markers nkp prints, with durations that grow with the
+    control plane and worker replica counts and controller log noise while
+    waiting.
+    """
+    rng = random.Random(seed)
+    control_plane = _flag(argv, "control-plane-replicas", 3)
+    workers = _flag(argv, "worker-replicas", 4)
+    seconds = {
+        "bootstrap": 60, "capi_providers": 30, "cluster_resources": 5, "infrastructure": 90,
+        "control_plane": 60 + 90 * control_plane, "workers": 60 + 30 * workers, "pivot": 120, "cleanup": 20,
+    }
+    phases = {}
+    for marker in NKP_PHASE_MARKERS:
+        phases.setdefault(marker.phase, []).append(marker.phrase)
+    if "--self-managed" not in argv and not any(arg.startswith("--self-managed=") for arg in argv):
+        phases.pop("pivot", None)
+
+    transcript = Transcript()
+    for phase, phrases in phases.items():
+        share = seconds[phase] / len(phrases)
+        for phrase in phrases:
+            transcript.lines.append(TranscriptLine(0.05, "stdout", f" • {phrase}\n"))
+            waited = 0.0
+            while waited < share:
+                delay = rng.uniform(1, 5)
+                waited += delay
+                transcript.lines.append(TranscriptLine(delay, "stderr", (
+                    f"I1018 12:00:00.000000 1 controller.go:{rng.randint(100, 999)}] "
+                    f"\"Reconciling\" phase=\"{phase}\" attempt={rng.randint(1, 20)}\n"
+                )))
+            transcript.lines.append(TranscriptLine(0.05, "stdout", f" ✓ {phrase}\n"))
+    transcript.lines.append(TranscriptLine(0.05, "stdout", "Cluster default/simulated is ready\n"))
+    return transcript
+
+
+@dataclass
+class SimulatorOptions:
+    # Multiplies the recorded delays, 0 replays as fast as possible
+    time_scale: float = 1.0
+    # Extra stderr noise lines written per transcript line
+    stderr_ratio: float = 0.0
+    # When set, a line this long is written without a newline before the exit
+    long_line_bytes: int = 0
+    # Overrides the transcript's exit code
+    exit_code: Optional[int] = None
+    seed: int = 0
+
+
+class SimulatedProcess:
+    """Plays a transcript into a run's log files, like a detached subprocess would.
+
+    The exit code goes to the run's exit file, as the detached.py wrapper
+    writes it. It still only lives as long as the server does.
+    """
+
+    def __init__(self, transcript: Transcript, options: SimulatorOptions, files: RunFiles):
+        self.transcript = transcript
+        self.options = options
+        self.returncode: Optional[int] = None
+        self.pid = None
+        self.files = files
+        self._outputs = {stream: open(path, "wb") for stream, path in files.outputs().items()}
+        self._done = asyncio.Event()
+        self._task = asyncio.create_task(self._play())
+
+    def _write(self, stream: str, data: bytes):
+        self._outputs[stream].write(data)
+        self._outputs[stream].flush()
+
+    async def _play(self):
+        rng = random.Random(self.options.seed)
+        code = self.options.exit_code if self.options.exit_code is not None else self.transcript.exit_code
+        try:
+            for line in self.transcript.lines:
+                if line.delay and self.options.time_scale:
+                    await asyncio.sleep(line.delay * self.options.time_scale)
+                elif not self.options.time_scale:
+                    # Still let the readers run between lines
+                    await asyncio.sleep(0)
+                self._write(line.stream, line.data.encode("utf-8"))
+                noise = int(self.options.stderr_ratio) + (rng.random() < self.options.stderr_ratio % 1)
+                for _ in range(noise):
+                    self._write("stderr", b"W1018 12:00:00.000000 1 reflector.go:535] simulated warning\n")
+            if self.options.long_line_bytes:
+                self._write("stdout", b"x" * self.options.long_line_bytes)
+        except asyncio.CancelledError:
+            code = -15
+            raise
+        finally:
+            for f in self._outputs.values():
+                f.close()
+            write_exit_code(self.files.exit_code, code)
+            self.returncode = code
+            self._done.set()
+
+    async def wait(self) -> int:
+        await self._done.wait()
+        return self.returncode
+
+    def terminate(self):
+        self._task.cancel()
+
+    kill = terminate
+
+
+class SimulatorExecutor:
+    """Replays a transcript instead of running nkp.
+
+    With no transcript, each run replays a synthetic one shaped by its own
+    argv (see synthetic_transcript).
+    """
+
+    def __init__(self, transcript: Optional[Transcript] = None, options: Optional[SimulatorOptions] = None):
+        self.transcript = transcript
+        self.options = options or SimulatorOptions()
+
+    async def spawn(self, argv: List[str], files: RunFiles) -> SimulatedProcess:
+        transcript = self.transcript or synthetic_transcript(argv, self.options.seed)
+        return SimulatedProcess(transcript, self.options, files)
+
+
+def executor_from_env(environ=os.environ):
+    """NKP_EXECUTOR=simulator swaps nkp for the simulator, see NKP_SIMULATOR_*."""
+    if environ.get("NKP_EXECUTOR", "subprocess") != "simulator":
+        return SubprocessExecutor()
+    path = environ.get("NKP_SIMULATOR_TRANSCRIPT")
+    exit_code = environ.get("NKP_SIMULATOR_EXIT_CODE")
+    return SimulatorExecutor(load_transcript(path) if path else None, SimulatorOptions(
+        time_scale=float(environ.get("NKP_SIMULATOR_TIME_SCALE", 1.0)),
+        stderr_ratio=float(environ.get("NKP_SIMULATOR_STDERR_RATIO", 0.0)),
+        long_line_bytes=int(environ.get("NKP_SIMULATOR_LONG_LINE_BYTES", 0)),
+        exit_code=int(exit_code) if exit_code is not None else None,
+    ))
+
+
+executor = executor_from_env()
+
+
+def use_executor(new_executor):
+    """Swap the executor deployments start with, e.g. for load tests."""
+    global executor
+    executor = new_executor
+
+
+async def spawn_detached(argv: List[str], base: str) -> DetachedRun:
+    """Start ``argv`` so it survives a server restart, see detached.py.
+
+    Output goes to files next to ``base`` (read them with
+    process_output.tail_output). The pid and process group are saved there,
+    and the run claimed for this process, before this returns.
+    """
+    os.makedirs(os.path.dirname(base) or ".", exist_ok=True)
+    files = RunFiles(base)
+    start = time.perf_counter()
+    process = await executor.spawn(argv, files)
+    spawn_latency.observe(time.perf_counter() - start)
+    # The wrapper leads its own session, so its pid is also the process group
+    run = DetachedRun(files, process.pid, process.pid, list(argv), time.time(), process)
+    run.claim()
+    run.save()
+    return run
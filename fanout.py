@@ -0,0 +1,181 @@
+# fanout.py
+import asyncio
+from collections import deque
+from enum import Enum
+from typing import AsyncIterator, Callable, Deque, Generic, List, Optional, Tuple, TypeVar
+
+
+T = TypeVar("T")
+
+
+class OverflowPolicy(str, Enum):
+    DROP_OLDEST = "drop_oldest"  # discard the oldest queued item
+    COALESCE = "coalesce"        # merge the new item into the newest queued one
+    DISCONNECT = "disconnect"    # end the subscription, the client resumes by id
+
+
+class SubscriberOverflow(Exception):
+    """Raised to a subscriber that fell too far behind under DISCONNECT."""
+
+
+class RingBuffer(Generic[T]):
+    """The most recent ``capacity`` items, each with a sequential id starting at 1."""
+
+    def __init__(self, capacity: int):
+        self._items: Deque[Tuple[int, T]] = deque(maxlen=capacity)
+        self.last_id = 0
+
+    @property
+    def first_id(self) -> int:
+        return self._items[0][0] if self._items else self.last_id + 1
+
+    def append(self, item: T) -> Tuple[int, T]:
+        self.last_id += 1
+        entry = (self.last_id, item)
+        self._items.append(entry)
+        return entry
+
+    def since(self, last_id: int) -> List[Tuple[int, T]]:
+        """Items with an id greater than ``last_id`` that are still buffered."""
+        skip = max(last_id - self.first_id + 1, 0)
+        return [entry for i, entry in enumerate(self._items) if i >= skip]
+
+
+class Subscriber(Generic[T]):
+    """Bounded queue feeding one consumer.
+
+    ``push`` never blocks the producer. When the queue is full the configured
+    ``policy`` decides what gives: the oldest item, the newest two items merged
+    by ``coalesce`` (falling back to dropping the oldest when they can't be
+    merged), or the subscription itself.
+    """
+
+    def __init__(self, maxsize: int, policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST,
+                 coalesce: Optional[Callable[[T, T], Optional[T]]] = None):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.coalesce = coalesce
+        self.dropped = 0
+        self.overflowed = False
+        self.closed = False
+        self._queue: Deque[T] = deque()
+        self._ready = asyncio.Event()
+
+    def push(self, item: T):
+        if self.closed:
+            return
+        if len(self._queue) >= self.maxsize:
+            if self.policy == OverflowPolicy.DISCONNECT:
+                self.overflowed = True
+                self.close()
+                return
+            merged = None
+            if self.policy == OverflowPolicy.COALESCE and self.coalesce is not None:
+                merged = self.coalesce(self._queue[-1], item)
+            if merged is not None:
+                self._queue[-1] = merged
+                return
+            self._queue.popleft()
+            self.dropped += 1
+        self._queue.append(item)
+        self._ready.set()
+
+    def close(self):
+        self.closed = True
+        self._ready.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> T:
+        while True:
+            if self.overflowed:
+                raise SubscriberOverflow()
+            if self._queue:
+                return self._queue.popleft()
+            if self.closed:
+                raise StopAsyncIteration
+            self._ready.clear()
+            await self._ready.wait()
+
+
+async def batched(items: AsyncIterator[T], window: float, max_items: int,
+                  merge: Optional[Callable[[T, T], Optional[T]]] = None,
+                  max_buffered: Optional[int] = None) -> AsyncIterator[List[T]]:
+    """Group ``items`` into lists, so a consumer writes once per list.
+
+    A list is handed over ``window`` seconds after its first item arrived,
+    or as soon as it holds ``max_items`` items, whichever is first; the
+    first item is never held back longer than ``window``. Consecutive items
+    that ``merge`` can combine become one. If ``items`` raises, what was
+    gathered so far is handed over first.
+
+    ``items`` is read by a task of its own, so a burst goes out in one list
+    however big. It stops reading once ``max_buffered`` items (by default
+    ``max_items``) wait for a consumer that is behind, and a Subscriber's
+    overflow policy takes over from there.
+    """
+    max_buffered = max(max_buffered or max_items, max_items)
+    loop = asyncio.get_running_loop()
+    batch: List[T] = []
+    count, started = 0, 0.0
+    ended, error = False, None
+    # Set once the list has an item, once it is full (or items ended), and once the consumer took it
+    arrived, full, taken = asyncio.Event(), asyncio.Event(), asyncio.Event()
+
+    async def gather():
+        nonlocal count, started, ended, error
+        try:
+            async for item in items:
+                while count >= max_buffered:
+                    taken.clear()
+                    await taken.wait()
+                merged = merge(batch[-1], item) if batch and merge is not None else None
+                if merged is not None:
+                    batch[-1] = merged
+                else:
+                    batch.append(item)
+                if count == 0:
+                    started = loop.time()
+                    arrived.set()
+                count += 1
+                if count >= max_items:
+                    full.set()
+        except Exception as e:
+            error = e
+        finally:
+            ended = True
+            arrived.set()
+            full.set()
+            aclose = getattr(items, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    task = loop.create_task(gather())
+    try:
+        while True:
+            await arrived.wait()
+            remaining = started + window - loop.time()
+            if not full.is_set() and remaining > 0:
+                # The window ending counts as full; cheaper to wake from than a wait_for
+                timer = loop.call_later(remaining, full.set)
+                try:
+                    await full.wait()
+                finally:
+                    timer.cancel()
+            taking = batch[:]
+            batch.clear()
+            count = 0
+            if not ended:
+                arrived.clear()
+                full.clear()
+            taken.set()
+            if taking:
+                yield taking
+            if ended and not batch:
+                if error is not None:
+                    raise error
+                return
+    finally:
+        task.cancel()
+        await asyncio.wait((task,))
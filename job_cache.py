@@ -0,0 +1,115 @@
+# job_cache.py
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from db import Job
+
+
+@dataclass
+class CachedJob:
+    """The scalar columns of a Job, as last written by its runner."""
+    id: str
+    status: str
+    cluster_name: Optional[str]
+    command: Optional[str]
+    parameters: Optional[Dict[str, Any]]
+    created_at: datetime
+    updated_at: datetime
+    progress: int
+    phase: Optional[str]
+    phase_timeline: Optional[List[dict]]
+    exit_code: Optional[int]
+    started_at: Optional[datetime]
+    # Newest job_log_chunks seq, tracked from log events for ETags
+    last_seq: int = -1
+    # Only jobs started after the chunk store are cached, so they never have
+    # output in the legacy log columns
+    stdout: str = ""
+    stderr: str = ""
+
+    @classmethod
+    def from_job(cls, job: Job, last_seq: int = -1) -> "CachedJob":
+        return cls(
+            id=job.id,
+            status=job.status,
+            cluster_name=job.cluster_name,
+            command=job.command,
+            parameters=job.parameters,
+            created_at=job.created_at,
+            updated_at=job.updated_at,
+            progress=job.progress,
+            phase=job.phase,
+            phase_timeline=job.phase_timeline,
+            exit_code=job.exit_code,
+            started_at=job.started_at,
+            last_seq=last_seq,
+        )
+
+
+class JobStateCache:
+    """Bounded LRU cache of running jobs with a per-entry TTL.
+
+    Entries are written through by the job runner on every status, progress
+    and output change and dropped when the job finishes, so a hit is always
+    at least as fresh as the database.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, tuple[float, CachedJob]]" = OrderedDict()
+
+    def get(self, job_id: str) -> Optional[CachedJob]:
+        entry = self._entries.get(job_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[job_id]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(job_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, job: CachedJob):
+        self._entries[job.id] = (time.monotonic() + self.ttl, job)
+        self._entries.move_to_end(job.id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def apply_event(self, job: CachedJob, event: dict):
+        """Write a job_events event through to the runner's ``job`` and cache it.
+
+        The runner keeps hold of its job, so one dropped for its TTL or to
+        make room is cached again, up to date, with its next event.
+        """
+        if event["type"] == "log":
+            job.last_seq = max(job.last_seq, event["seq"])
+        else:
+            job.status = event["status"]
+            job.progress = event["progress"]
+            job.phase = event["phase"]
+            job.phase_timeline = event["phase_timeline"]
+            job.exit_code = event["exit_code"]
+            job.updated_at = datetime.fromisoformat(event["updated_at"])
+        self.put(job)
+
+    def invalidate(self, job_id: str):
+        self._entries.pop(job_id, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else None,
+        }
@@ -0,0 +1,63 @@
+# job_events.py
+import functools
+from typing import Callable, Dict, Set
+
+from event_bus import LocalEventBus, event_bus
+from fanout import OverflowPolicy, Subscriber
+
+
+# Events queued per viewer; dropped log events are re-read from the DB
+SUBSCRIBER_QUEUE_SIZE = 256
+FINAL_STATUSES = ("completed", "failed")
+
+
+class JobEventHub:
+    """Pub/sub of job status and log events, keyed by job id.
+
+    Events are plain dicts:
+    ``{"type": "status", "status", "progress", "phase", "phase_timeline",
+    "exit_code", "updated_at"}`` or
+    ``{"type": "log", "seq", "stream", "offset", "next_offset", "data"}``.
+    They are published only after the change is committed, so a subscriber
+    that misses one can always catch up from the database.
+
+    Events go through ``bus``, so with a cross-process bus a job run by one
+    worker can be followed from any other. Log events may arrive there
+    without their ``data`` if it was too big to send; read it from the
+    database instead.
+    """
+
+    def __init__(self, bus: LocalEventBus = event_bus):
+        self.bus = bus
+        self._subscribers: Dict[str, Set[Subscriber]] = {}
+        # The bus handler of each job with subscribers here
+        self._handlers: Dict[str, Callable[[dict], None]] = {}
+
+    def subscribe(self, job_id: str) -> Subscriber:
+        subscriber = Subscriber(SUBSCRIBER_QUEUE_SIZE, OverflowPolicy.DROP_OLDEST)
+        subscribers = self._subscribers.get(job_id)
+        if subscribers is None:
+            subscribers = self._subscribers[job_id] = set()
+            handler = self._handlers[job_id] = functools.partial(self._push, job_id)
+            self.bus.subscribe(f"job:{job_id}", handler)
+        subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, job_id: str, subscriber: Subscriber):
+        subscribers = self._subscribers.get(job_id)
+        if subscribers is None:
+            return
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del self._subscribers[job_id]
+            self.bus.unsubscribe(f"job:{job_id}", self._handlers.pop(job_id))
+
+    def publish(self, job_id: str, event: dict):
+        self.bus.publish(f"job:{job_id}", event, strip=("data",))
+
+    def _push(self, job_id: str, event: dict):
+        for subscriber in self._subscribers.get(job_id, ()):
+            subscriber.push(event)
+
+
+job_events = JobEventHub()
@@ -0,0 +1,184 @@
+# log_archive.py
+import json
+import os
+import re
+import zlib
+from typing import Iterator, List, Optional, Union
+
+from fastapi.responses import Response, StreamingResponse
+
+
+# Where finished jobs' logs are archived, one directory per job. Once a job
+# is archived its output is only here, so with workers on more than one
+# host this has to be storage they all share (NKP_LOG_ARCHIVE_DIR).
+LOG_ARCHIVE_DIR = os.environ.get("NKP_LOG_ARCHIVE_DIR", "log_archive")
+# Uncompressed bytes per gzip member; a range read decompresses at most this much extra per end
+SEGMENT_SIZE = 1024 * 1024
+# Bytes per read when passing the compressed file through
+READ_SIZE = 64 * 1024
+
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+def job_archive_path(job_id: str, stream: str) -> str:
+    return os.path.join(LOG_ARCHIVE_DIR, job_id, stream)
+
+
+class LogArchiveWriter:
+    """Appends a log to ``<path>.gz`` as a series of gzip members.
+
+    Every ``segment_size`` bytes of input are compressed into their own gzip
+    member and recorded in ``<path>.idx.json`` as ``[raw_offset, raw_length,
+    gz_offset, gz_length]``. Concatenated members are still one valid gzip
+    file, so the file can be sent as-is to clients that accept gzip, and a
+    byte range only needs the members it overlaps decompressed.
+
+    The index is replaced atomically after each member is written, so a
+    reader never sees a member that isn't complete on disk.
+    """
+
+    def __init__(self, path: str, segment_size: int = SEGMENT_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(f"{path}.gz", "wb")
+        self._pending: List[bytes] = []
+        self._pending_bytes = 0
+        self._segments: List[List[int]] = []
+        self._raw_size = 0
+        self._gz_size = 0
+
+    @property
+    def data_path(self) -> str:
+        return f"{self.path}.gz"
+
+    def write(self, data: Union[str, bytes]):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if not data:
+            return
+        self._pending.append(data)
+        self._pending_bytes += len(data)
+        if self._pending_bytes >= self.segment_size:
+            self.flush()
+
+    def flush(self):
+        """Compress buffered bytes into a new member and publish it in the index."""
+        if not self._pending:
+            return
+        raw = b"".join(self._pending)
+        self._pending, self._pending_bytes = [], 0
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        member = compressor.compress(raw) + compressor.flush()
+        self._file.write(member)
+        self._file.flush()
+        self._segments.append([self._raw_size, len(raw), self._gz_size, len(member)])
+        self._raw_size += len(raw)
+        self._gz_size += len(member)
+        self._write_index()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+        # Empty logs still get an index, so the archive exists
+        self._write_index()
+
+    def _write_index(self):
+        tmp = f"{self.path}.idx.json.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"raw_size": self._raw_size, "gz_size": self._gz_size, "segments": self._segments}, f)
+        os.replace(tmp, f"{self.path}.idx.json")
+
+
+class LogArchive:
+    """Read side of a LogArchiveWriter archive, as of when it was opened."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(f"{path}.idx.json", encoding="utf-8") as f:
+            index = json.load(f)
+        self.size: int = index["raw_size"]
+        self.compressed_size: int = index["gz_size"]
+        self.segments: List[List[int]] = index["segments"]
+
+    @classmethod
+    def open(cls, path: str) -> Optional["LogArchive"]:
+        """The archive at ``path``, None if there is none."""
+        try:
+            return cls(path)
+        except FileNotFoundError:
+            return None
+
+    def iter_range(self, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        """Uncompressed bytes ``start`` up to ``end`` (exclusive), a segment at a time."""
+        end = self.size if end is None else min(end, self.size)
+        with open(f"{self.path}.gz", "rb") as f:
+            for raw_offset, raw_length, gz_offset, gz_length in self.segments:
+                if raw_offset + raw_length <= start:
+                    continue
+                if raw_offset >= end:
+                    break
+                f.seek(gz_offset)
+                raw = zlib.decompress(f.read(gz_length), 31)
+                yield raw[max(start - raw_offset, 0):end - raw_offset]
+
+    def iter_compressed(self) -> Iterator[bytes]:
+        """The gzip file as stored, up to the last indexed member."""
+        remaining = self.compressed_size
+        with open(f"{self.path}.gz", "rb") as f:
+            while remaining > 0:
+                data = f.read(min(READ_SIZE, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+
+    def read_from(self, offset: int = 0) -> bytes:
+        return b"".join(self.iter_range(offset))
+
+
+def _accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    for coding in (accept_encoding or "").split(","):
+        name, _, params = coding.strip().partition(";")
+        if name.strip().lower() in ("gzip", "x-gzip"):
+            return params.replace(" ", "").lower() not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+def archive_response(archive: LogArchive, range_header: Optional[str] = None,
+                     accept_encoding: Optional[str] = None, filename: Optional[str] = None,
+                     media_type: str = "text/plain; charset=utf-8") -> Response:
+    """Stream ``archive``, honouring a single ``Range`` and passing gzip through.
+
+    Ranges are in uncompressed bytes and are answered uncompressed; a full
+    download goes out as the stored gzip file when the client accepts it.
+    Memory use is bounded by one segment either way.
+    """
+    headers = {"Accept-Ranges": "bytes", "Vary": "Accept-Encoding"}
+    if filename:
+        headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+
+    match = _RANGE.fullmatch((range_header or "").strip())
+    if match and (match.group(1) or match.group(2)):
+        first, last = match.groups()
+        if first:
+            start, end = int(first), int(last) + 1 if last else archive.size
+        else:
+            start, end = max(archive.size - int(last), 0), archive.size
+        end = min(end, archive.size)
+        if start >= end:
+            headers["Content-Range"] = f"bytes */{archive.size}"
+            return Response(status_code=416, headers=headers)
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{archive.size}"
+        headers["Content-Length"] = str(end - start)
+        return StreamingResponse(archive.iter_range(start, end), status_code=206,
+                                 media_type=media_type, headers=headers)
+
+    if _accepts_gzip(accept_encoding):
+        headers["Content-Encoding"] = "gzip"
+        headers["Content-Length"] = str(archive.compressed_size)
+        return StreamingResponse(archive.iter_compressed(), media_type=media_type, headers=headers)
+    headers["Content-Length"] = str(archive.size)
+    return StreamingResponse(archive.iter_range(), media_type=media_type, headers=headers)
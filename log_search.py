@@ -0,0 +1,186 @@
+# log_search.py
+import re
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session, load_only
+
+from db import Job, JobLogChunk, JobLogSearchEntry
+from log_archive import LogArchive, job_archive_path
+
+
+# Backends with a job_log_fts index (see db.JobLogSearchEntry)
+SUPPORTED_DIALECTS = ("postgresql", "sqlite")
+# Matching index entries fetched per round, newest first
+SEARCH_BATCH = 200
+# Stop after this many matching entries, so very common terms stay fast
+MAX_ENTRIES_SCANNED = 2000
+MAX_LINES_PER_JOB = 5
+# Legacy log text is indexed in spans of about this many bytes
+SPAN_BYTES = 64 * 1024
+
+# Terms are runs of letters and digits. SQLite's tokenizer splits text the
+# same way; Postgres' parser would keep hosts, IPs, versions and paths whole
+# (10.0.0.5, v1.29.6, /etc/kubernetes), so it is given the terms instead.
+_TERM = re.compile(r"[^\W_]+")
+
+# (job_id, stream, byte_offset, byte_length, text)
+Span = Tuple[str, str, int, int, str]
+
+
+def query_terms(query: str) -> List[str]:
+    return list(dict.fromkeys(term.lower() for term in _TERM.findall(query)))
+
+
+def _indexed_text(data: str) -> str:
+    """``data`` as the space-separated terms query_terms would find in it."""
+    return " ".join(_TERM.findall(data))
+
+
+def is_supported(db: Session) -> bool:
+    return db.get_bind().dialect.name in SUPPORTED_DIALECTS
+
+
+def split_spans(job_id: str, stream: str, data: str, byte_offset: int = 0,
+                span_bytes: int = SPAN_BYTES) -> Iterator[Span]:
+    """Cut ``data`` into spans of whole lines of about ``span_bytes``."""
+    lines: List[str] = []
+    size = 0
+    for line in data.splitlines(keepends=True):
+        lines.append(line)
+        size += len(line.encode("utf-8"))
+        if size >= span_bytes:
+            yield job_id, stream, byte_offset, size, "".join(lines)
+            byte_offset += size
+            lines, size = [], 0
+    if lines:
+        yield job_id, stream, byte_offset, size, "".join(lines)
+
+
+def index_spans(db: Session, spans: Sequence[Span]):
+    """Add output spans to the full-text index, in the caller's transaction."""
+    dialect = db.get_bind().dialect.name
+    if not spans or dialect not in SUPPORTED_DIALECTS:
+        return
+    entries = [
+        JobLogSearchEntry(job_id=job_id, stream=stream, byte_offset=byte_offset, byte_length=byte_length)
+        for job_id, stream, byte_offset, byte_length, _ in spans
+    ]
+    db.add_all(entries)
+    db.flush()
+    rows = [{"id": entry.id, "data": span[4]} for entry, span in zip(entries, spans)]
+    if dialect == "postgresql":
+        rows = [{"id": row["id"], "data": _indexed_text(row["data"])} for row in rows]
+        db.execute(text("INSERT INTO job_log_fts (entry_id, tsv) VALUES (:id, to_tsvector('simple', :data))"), rows)
+    else:
+        db.execute(text("INSERT INTO job_log_fts (rowid, data) VALUES (:id, :data)"), rows)
+
+
+def _matching_entry_ids(db: Session, terms: List[str], before: Optional[int], limit: int) -> List[int]:
+    params = {"limit": limit, "before": before}
+    if db.get_bind().dialect.name == "postgresql":
+        params["query"] = " ".join(terms)
+        sql = "SELECT entry_id FROM job_log_fts WHERE tsv @@ plainto_tsquery('simple', :query)"
+        if before is not None:
+            sql += " AND entry_id < :before"
+        sql += " ORDER BY entry_id DESC LIMIT :limit"
+    else:
+        # Quoted, so terms are never read as FTS5 operators
+        params["query"] = " ".join(f'"{term}"' for term in terms)
+        sql = "SELECT rowid FROM job_log_fts WHERE job_log_fts MATCH :query"
+        if before is not None:
+            sql += " AND rowid < :before"
+        sql += " ORDER BY rowid DESC LIMIT :limit"
+    return [row[0] for row in db.execute(text(sql), params)]
+
+
+class _SpanReader:
+    """Reads indexed spans back from the chunks or the log archive."""
+
+    def __init__(self, db: Session):
+        self.db = db
+        self._archives: Dict[Tuple[str, str], Optional[LogArchive]] = {}
+
+    def read(self, job: Job, entry: JobLogSearchEntry) -> bytes:
+        if job.logs_archived_at is not None:
+            key = (job.id, entry.stream)
+            if key not in self._archives:
+                self._archives[key] = LogArchive.open(job_archive_path(job.id, entry.stream))
+            archive = self._archives[key]
+            if archive is None:
+                return b""
+            return b"".join(archive.iter_range(entry.byte_offset, entry.byte_offset + entry.byte_length))
+        data = self.db.query(JobLogChunk.data).filter(
+            JobLogChunk.job_id == job.id,
+            JobLogChunk.stream == entry.stream,
+            JobLogChunk.byte_offset == entry.byte_offset,
+        ).scalar()
+        return (data or "").encode("utf-8")
+
+
+def _matching_lines(data: bytes, entry: JobLogSearchEntry, terms: List[str], limit: int) -> List[dict]:
+    wanted = set(terms)
+    lines = []
+    offset = entry.byte_offset
+    for line in data.splitlines(keepends=True):
+        decoded = line.decode("utf-8", errors="replace")
+        if wanted <= {term.lower() for term in _TERM.findall(decoded)}:
+            lines.append({"stream": entry.stream, "offset": offset, "line": decoded.rstrip("\r\n")})
+            if len(lines) >= limit:
+                break
+        offset += len(line)
+    return lines
+
+
+def search_logs(db: Session, query: str, limit: int = 20, status: Optional[str] = None) -> List[dict]:
+    """Jobs whose output contains every term of ``query``, newest output first.
+
+    Each result lists up to MAX_LINES_PER_JOB matching lines with their
+    byte offsets in the stream, the same offsets /api/status takes.
+    """
+    terms = query_terms(query)
+    if not terms:
+        return []
+    reader = _SpanReader(db)
+    results: Dict[str, dict] = {}
+    before = None
+    scanned = 0
+    while len(results) < limit and scanned < MAX_ENTRIES_SCANNED:
+        ids = _matching_entry_ids(db, terms, before, SEARCH_BATCH)
+        if not ids:
+            break
+        scanned += len(ids)
+        before = ids[-1]
+
+        entries = db.query(JobLogSearchEntry).filter(JobLogSearchEntry.id.in_(ids)).order_by(
+            JobLogSearchEntry.id.desc()
+        ).all()
+        jobs = {job.id: job for job in db.query(Job).options(load_only(
+            Job.id, Job.status, Job.cluster_name, Job.created_at, Job.logs_archived_at,
+        )).filter(Job.id.in_({entry.job_id for entry in entries}))}
+
+        for entry in entries:
+            job = jobs[entry.job_id]
+            if status is not None and job.status != status:
+                continue
+            result = results.get(job.id)
+            if result is None and len(results) >= limit:
+                continue
+            room = MAX_LINES_PER_JOB - (len(result["matches"]) if result else 0)
+            if room <= 0:
+                continue
+            # An entry can match on terms that are on different lines
+            lines = _matching_lines(reader.read(job, entry), entry, terms, room)
+            if not lines:
+                continue
+            if result is None:
+                result = results[job.id] = {
+                    "job_id": job.id,
+                    "cluster_name": job.cluster_name,
+                    "status": job.status,
+                    "created_at": job.created_at,
+                    "matches": [],
+                }
+            result["matches"] += lines
+
+    return list(results.values())
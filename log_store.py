@@ -0,0 +1,329 @@
+# log_store.py
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import func, or_, update
+from sqlalchemy.orm import Session
+
+from db import Job, JobLogChunk, JobLogSearchEntry, SessionLocal
+from job_events import FINAL_STATUSES
+from log_archive import LogArchive, LogArchiveWriter, job_archive_path
+from log_search import index_spans, split_spans
+from metrics import db_commit_latency
+
+
+STREAMS = ("stdout", "stderr")
+# A worker that took a job to archive this long ago is presumed to have died at it
+ARCHIVE_CLAIM_TIMEOUT = timedelta(hours=1)
+
+# Archiving reads, compresses and maybe indexes a whole log. It gets a thread
+# of its own rather than the DB writer's, which running jobs' output waits on.
+log_archiver = ThreadPoolExecutor(max_workers=1, thread_name_prefix="log-archiver")
+
+_output_commit_latency = db_commit_latency.labels("output")
+_status_commit_latency = db_commit_latency.labels("status")
+
+
+class JobLogWriter:
+    """Buffered, append-only writer for a job's output.
+
+    Lines are collected in memory and written to ``job_log_chunks`` as a single
+    insert once ``flush_bytes`` have been buffered or ``flush_interval`` seconds
+    have passed since the last flush. Status and progress changes are committed
+    immediately, together with whatever output is still buffered.
+
+    ``write`` only touches memory. Everything else opens a short-lived session
+    from ``session_factory`` and is meant to run on the DB writer thread (see
+    ``db.run_db``), so it never blocks the event loop or holds a pooled
+    connection between writes.
+
+    ``on_event`` is called with a log or status event (see job_events) after
+    each commit, on the thread that committed.
+
+    Output read from a file can be written with its ``source_offset``, the
+    file offset just past it. The latest offset per stream is committed to
+    ``Job.output_offsets`` with the chunks, so after a restart reading
+    resumes exactly where the stored output ends.
+    """
+
+    def __init__(self, job_id: str, session_factory: Callable[[], Session] = SessionLocal,
+                 flush_bytes: int = 64 * 1024, flush_interval: float = 1.0,
+                 on_event: Optional[Callable[[dict], None]] = None):
+        self.job_id = job_id
+        self.session_factory = session_factory
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.on_event = on_event
+
+        # Guards the buffer, which write() fills while a flush may be running
+        self._lock = threading.Lock()
+        self._pending: List[Tuple[str, str]] = []
+        self._pending_bytes = 0
+        self._pending_offsets: Dict[str, int] = {}
+        self._last_flush = time.monotonic()
+
+        self._load_position()
+
+    def _load_position(self):
+        # Resume after any chunks already stored for this job
+        with self.session_factory() as db:
+            self._seq = last_chunk_seq(db, self.job_id) + 1
+            self._offsets = {stream: 0 for stream in STREAMS}
+            rows = db.query(
+                JobLogChunk.stream,
+                func.max(JobLogChunk.byte_offset + JobLogChunk.byte_length),
+            ).filter(JobLogChunk.job_id == self.job_id).group_by(JobLogChunk.stream).all()
+            for stream, end in rows:
+                self._offsets[stream] = end or 0
+            self.source_offsets = dict(db.query(Job.output_offsets).filter(Job.id == self.job_id).scalar() or {})
+
+    def write(self, stream: str, text: str, source_offset: Optional[int] = None):
+        """Buffer ``text`` for ``stream``."""
+        if not text:
+            return
+        with self._lock:
+            self._pending.append((stream, text))
+            self._pending_bytes += len(text.encode("utf-8"))
+            if source_offset is not None:
+                self._pending_offsets[stream] = source_offset
+
+    @property
+    def flush_due(self) -> bool:
+        """Whether enough output is buffered, or for long enough, to flush."""
+        return bool(self._pending) and (
+            self._pending_bytes >= self.flush_bytes or time.monotonic() - self._last_flush >= self.flush_interval
+        )
+
+    def flush(self):
+        """Write buffered output as chunks and commit."""
+        self._commit()
+
+    def set_progress(self, progress: int, **values):
+        values["progress"] = progress
+        self._commit(**values)
+
+    def set_values(self, **values):
+        """Commit other Job columns, with whatever output is buffered."""
+        self._commit(**values)
+
+    def set_status(self, status: str, exit_code: Optional[int] = None, **values):
+        values["status"] = status
+        if exit_code is not None:
+            values["exit_code"] = exit_code
+        self._commit(**values)
+
+    def close(self):
+        self.flush()
+
+    def _commit(self, **values):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            offsets, self._pending_offsets = self._pending_offsets, {}
+            self._pending_bytes = 0
+            self._last_flush = time.monotonic()
+        if not pending and not values:
+            return
+        columns = dict(values)
+        if offsets:
+            columns["output_offsets"] = {**self.source_offsets, **offsets}
+
+        position = self._seq, dict(self._offsets)
+        chunks, events = self._make_chunks(pending)
+        started = time.perf_counter()
+        try:
+            with self.session_factory() as db:
+                db.add_all(chunks)
+                # Searchable in the same commit the output becomes readable
+                index_spans(db, [
+                    (chunk.job_id, chunk.stream, chunk.byte_offset, chunk.byte_length, chunk.data) for chunk in chunks
+                ])
+                if columns:
+                    # Update only the scalar columns so the row's log text is never rewritten
+                    db.execute(update(Job).where(Job.id == self.job_id).values(**columns))
+                db.commit()
+                if offsets:
+                    self.source_offsets = columns["output_offsets"]
+                (_status_commit_latency if values else _output_commit_latency).observe(time.perf_counter() - started)
+                if values and self.on_event is not None:
+                    job = db.query(Job.status, Job.progress, Job.phase, Job.phase_timeline, Job.exit_code,
+                                   Job.updated_at).filter(
+                        Job.id == self.job_id
+                    ).one()
+                    events.append({
+                        "type": "status",
+                        "status": job.status,
+                        "progress": job.progress,
+                        "phase": job.phase,
+                        "phase_timeline": job.phase_timeline,
+                        "exit_code": job.exit_code,
+                        "updated_at": job.updated_at.isoformat(),
+                    })
+        except Exception:
+            # The chunks never made it, don't leave a gap in seq or offsets. Not
+            # reloaded from the database, which may be what just failed.
+            self._seq, self._offsets = position
+            raise
+
+        if self.on_event is not None:
+            for event in events:
+                self.on_event(event)
+
+    def _make_chunks(self, pending: List[Tuple[str, str]]) -> Tuple[List[JobLogChunk], List[dict]]:
+        # Coalesce consecutive writes to the same stream, preserving interleaving
+        runs: List[Tuple[str, List[str]]] = []
+        for stream, text in pending:
+            if runs and runs[-1][0] == stream:
+                runs[-1][1].append(text)
+            else:
+                runs.append((stream, [text]))
+
+        chunks, events = [], []
+        for stream, parts in runs:
+            data = "".join(parts)
+            length = len(data.encode("utf-8"))
+            chunks.append(JobLogChunk(
+                job_id=self.job_id,
+                seq=self._seq,
+                stream=stream,
+                byte_offset=self._offsets[stream],
+                byte_length=length,
+                data=data,
+            ))
+            events.append({
+                "type": "log",
+                "seq": self._seq,
+                "stream": stream,
+                "offset": self._offsets[stream],
+                "next_offset": self._offsets[stream] + length,
+                "data": data,
+            })
+            self._seq += 1
+            self._offsets[stream] += length
+        return chunks, events
+
+
+def read_log_from(db: Session, job: Job, stream: str, offset: int = 0) -> Tuple[str, int]:
+    """Return the bytes of ``stream`` after ``offset`` and the offset to ask for next.
+
+    Offsets count UTF-8 bytes from the start of the stream, including any
+    legacy column text, so clients can poll for just the new output.
+    """
+    if getattr(job, "logs_archived_at", None) is not None:
+        return _read_archived(job.id, stream, offset)
+
+    legacy = (getattr(job, stream) or "").encode("utf-8")
+    parts = [legacy[offset:]] if offset < len(legacy) else []
+    chunk_offset = max(offset - len(legacy), 0)
+
+    chunks = db.query(JobLogChunk.byte_offset, JobLogChunk.data).filter(
+        JobLogChunk.job_id == job.id,
+        JobLogChunk.stream == stream,
+        JobLogChunk.byte_offset + JobLogChunk.byte_length > chunk_offset,
+    ).order_by(JobLogChunk.seq).all()
+
+    end = len(legacy) + chunk_offset
+    for byte_offset, data in chunks:
+        encoded = data.encode("utf-8")
+        parts.append(encoded[max(chunk_offset - byte_offset, 0):])
+        end = len(legacy) + byte_offset + len(encoded)
+
+    if job.status in FINAL_STATUSES and db.query(Job.logs_archived_at).filter(Job.id == job.id).scalar() is not None:
+        # Archived while this was being read, so some of it may have been deleted already
+        return _read_archived(job.id, stream, offset)
+    return b"".join(parts).decode("utf-8", errors="replace"), max(end, offset)
+
+
+def _read_archived(job_id: str, stream: str, offset: int) -> Tuple[str, int]:
+    archive = LogArchive.open(job_archive_path(job_id, stream))
+    if archive is None:
+        return "", offset
+    return archive.read_from(offset).decode("utf-8", errors="replace"), max(archive.size, offset)
+
+
+def last_chunk_seq(db: Session, job_id: str) -> int:
+    """Sequence number of the newest chunk, -1 if the job has no output yet."""
+    return db.query(func.coalesce(func.max(JobLogChunk.seq), -1)).filter(
+        JobLogChunk.job_id == job_id
+    ).scalar()
+
+
+async def archive_logs(job_id: str):
+    """archive_job_logs on the log archiver thread, with sessions of its own."""
+    await asyncio.get_running_loop().run_in_executor(log_archiver, archive_job_logs, job_id)
+
+
+def claim_archiving(job_id: str, session_factory: Callable[[], Session] = SessionLocal) -> bool:
+    """Take an unarchived job to archive; False if it's archived or another worker has it."""
+    now = datetime.now()
+    with session_factory() as db:
+        claimed = db.execute(update(Job).where(
+            Job.id == job_id,
+            Job.logs_archived_at.is_(None),
+            or_(Job.logs_archiving_at.is_(None), Job.logs_archiving_at < now - ARCHIVE_CLAIM_TIMEOUT),
+        ).values(logs_archiving_at=now, updated_at=Job.updated_at)).rowcount == 1
+        db.commit()
+    return claimed
+
+
+def archive_job_logs(job_id: str, session_factory: Callable[[], Session] = SessionLocal, batch_size: int = 256):
+    """Move a finished job's output from the database to the log archive.
+
+    The archive holds the same bytes, at the same offsets, as the legacy
+    columns followed by the chunks. The chunks are deleted and the legacy
+    columns emptied in the same commit that marks the job archived, so a
+    crash part way leaves the database copy in place to archive again.
+
+    Jobs whose output was never indexed for search (written before the
+    index existed) are indexed on the way.
+
+    Every worker sweeps for unarchived jobs, so a job is claimed first;
+    it is left alone if another worker has it or has archived it already.
+    """
+    if not claim_archiving(job_id, session_factory):
+        return
+    try:
+        _archive_claimed(job_id, session_factory, batch_size)
+    except Exception:
+        # Let the next sweep retry it instead of waiting out the claim
+        with session_factory() as db:
+            db.execute(update(Job).where(Job.id == job_id).values(logs_archiving_at=None, updated_at=Job.updated_at))
+            db.commit()
+        raise
+
+
+def _archive_claimed(job_id: str, session_factory: Callable[[], Session], batch_size: int):
+    with session_factory() as db:
+        job = db.query(Job).filter(Job.id == job_id).one()
+        indexed = db.query(JobLogSearchEntry.id).filter(JobLogSearchEntry.job_id == job_id).first() is not None
+        for stream in STREAMS:
+            writer = LogArchiveWriter(job_archive_path(job_id, stream))
+            legacy = getattr(job, stream) or ""
+            writer.write(legacy)
+            legacy_bytes = len(legacy.encode("utf-8"))
+            spans = [] if indexed else list(split_spans(job_id, stream, legacy))
+
+            chunks = db.query(JobLogChunk.byte_offset, JobLogChunk.byte_length, JobLogChunk.data).filter(
+                JobLogChunk.job_id == job_id,
+                JobLogChunk.stream == stream,
+            ).order_by(JobLogChunk.seq).yield_per(batch_size)
+            for byte_offset, byte_length, data in chunks:
+                writer.write(data)
+                if not indexed:
+                    spans.append((job_id, stream, legacy_bytes + byte_offset, byte_length, data))
+                    if len(spans) >= batch_size:
+                        index_spans(db, spans)
+                        spans = []
+            writer.close()
+            index_spans(db, spans)
+
+        db.query(JobLogChunk).filter(JobLogChunk.job_id == job_id).delete(synchronize_session=False)
+        db.execute(update(Job).where(Job.id == job_id).values(
+            stdout="", stderr="", logs_archived_at=datetime.now(), logs_archiving_at=None,
+            # Archiving isn't a change to the job itself
+            updated_at=Job.updated_at,
+        ))
+        db.commit()
@@ -0,0 +1,107 @@
+# loop_monitor.py
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+from typing import Deque, Optional
+
+from metrics import loop_lag, loop_stalls
+
+
+# How often the loop is pinged
+LAG_INTERVAL = 0.05
+# A loop that hasn't answered for this long is stalled and its stack is captured
+STALL_THRESHOLD = 0.25
+# Stalls kept for the admin report
+MAX_STALLS = 50
+
+
+class LoopMonitor:
+    """Samples event loop lag and records what a blocked loop was doing.
+
+    A task on the loop wakes every ``interval`` seconds and records how late
+    it woke up. A watchdog thread watches those wake-ups; when the loop has
+    been silent for ``stall_threshold`` seconds it grabs the loop thread's
+    current stack, which points at the blocking call (a sync query, a big
+    template render) while it is still running.
+    """
+
+    def __init__(self, interval: float = LAG_INTERVAL, stall_threshold: float = STALL_THRESHOLD,
+                 max_stalls: int = MAX_STALLS):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self.stalls: Deque[dict] = deque(maxlen=max_stalls)
+        self.max_lag = 0.0
+        self._heartbeat = time.monotonic()
+        self._stall: Optional[dict] = None
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """Start monitoring the running loop; call from the loop, e.g. on startup."""
+        if self.running:
+            return
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.get_running_loop().create_task(self._tick())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _tick(self):
+        lag_child = loop_lag.labels()
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(now - expected, 0.0)
+            self._heartbeat = now
+            lag_child.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            stall, self._stall = self._stall, None
+            if stall is not None:
+                stall["blocked_seconds"] = round(lag, 3)
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            # Past when the ticker should have woken up
+            overdue = time.monotonic() - self._heartbeat - self.interval
+            if overdue < self.stall_threshold or self._stall is not None:
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            stall = {
+                "detected_at": datetime.now().isoformat(),
+                # Updated with the full duration once the loop wakes up
+                "blocked_seconds": round(overdue, 3),
+                "stack": traceback.format_stack(frame) if frame is not None else [],
+            }
+            self._stall = stall
+            self.stalls.append(stall)
+            loop_stalls.inc()
+
+    def report(self) -> dict:
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "stall_threshold": self.stall_threshold,
+            "max_lag_seconds": round(self.max_lag, 3),
+            "stalls": list(self.stalls)[::-1],
+        }
+
+
+loop_monitor = LoopMonitor()
@@ -0,0 +1,258 @@
+# metrics.py
+import bisect
+import math
+import threading
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from a quick DB commit up to a long deployment phase
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DURATION_BUCKETS = (10, 30, 60, 120, 300, 600, 900, 1200, 1800, 2700, 3600, 5400, 7200)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in pairs) + "}"
+
+
+class _Metric:
+    """A named metric with optional labels, in Prometheus text format.
+
+    ``labels(...)`` returns the child for one set of label values; hold on to
+    it on hot paths so an update is a single attribute add.
+
+    Counters and gauges aren't locked, which keeps them cheap enough for the
+    per-line path: update each one from a single thread (here, the event
+    loop). Histograms take a lock and can be observed from any thread.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 registry: Optional["Registry"] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else default_registry).register(self)
+        if not self.labelnames:
+            # Exported as 0 before the first update
+            self.labels()
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        if len(key) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {key}")
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _unlabelled(self):
+        if self.labelnames:
+            raise ValueError(f"{self.name} needs labels {self.labelnames}")
+        return self.labels()
+
+    def samples(self) -> Iterator[str]:
+        for values, child in list(self._children.items()):
+            yield from child.samples(self.name, self.labelnames, values)
+
+    def render(self) -> str:
+        documentation = self.documentation.replace("\\", "\\\\").replace("\n", "\\n")
+        lines = [f"# HELP {self.name} {documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def samples(self, name, labelnames, values):
+        yield f"{name}{_labels(labelnames, values)} {_format_value(self.value)}"
+
+
+class Counter(_Metric):
+    """Monotonically increasing count; name it ``*_total``."""
+
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self._unlabelled().inc(amount)
+
+
+class _GaugeChild:
+    __slots__ = ("value", "function")
+
+    def __init__(self):
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def set_function(self, function: Callable[[], float]):
+        """Read the value from ``function`` at scrape time instead."""
+        self.function = function
+
+    def samples(self, name, labelnames, values):
+        value = self.function() if self.function is not None else self.value
+        yield f"{name}{_labels(labelnames, values)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, or is read from a function when scraped."""
+
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self._unlabelled().set(value)
+
+    def inc(self, amount: float = 1):
+        self._unlabelled().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self._unlabelled().dec(amount)
+
+    def set_function(self, function: Callable[[], float]):
+        self._unlabelled().set_function(function)
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "_lock")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # One count per bound plus +Inf, not cumulative until rendered
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self, name, labelnames, values):
+        with self._lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.bounds + (math.inf,), counts):
+            cumulative += count
+            yield f"{name}_bucket{_labels(labelnames, values, ('le', _format_value(bound)))} {cumulative}"
+        yield f"{name}_sum{_labels(labelnames, values)} {_format_value(total)}"
+        yield f"{name}_count{_labels(labelnames, values)} {cumulative}"
+
+
+class Histogram(_Metric):
+    """Observations counted into fixed buckets, plus their sum and count."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS, registry: Optional["Registry"] = None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._unlabelled().observe(value)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric):
+        if any(existing.name == metric.name for existing in self._metrics):
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+default_registry = Registry()
+
+
+# Jobs and deployments
+jobs_total = Counter("nkp_jobs_total", "Jobs that reached each status", ["status"])
+deployment_duration = Histogram(
+    "nkp_deployment_duration_seconds", "Wall time from a job starting to it finishing, by outcome",
+    ["status"], buckets=DURATION_BUCKETS,
+)
+phase_duration = Histogram(
+    "nkp_phase_duration_seconds", "Time spent in each nkp phase of finished jobs",
+    ["phase"], buckets=DURATION_BUCKETS,
+)
+queue_depth = Gauge("nkp_queue_depth", "Deployments waiting for a free slot")
+running_deployments = Gauge("nkp_running_deployments", "Deployments currently running")
+spawn_latency = Histogram("nkp_process_spawn_seconds", "Time to start the nkp process")
+
+# Output and persistence
+output_lines = Counter("nkp_output_lines_total", "Lines of nkp output read", ["stream"])
+output_bytes = Counter("nkp_output_bytes_total", "Bytes of nkp output read", ["stream"])
+db_commit_latency = Histogram(
+    "nkp_db_commit_seconds", "Time to write and commit a job's buffered output and status changes", ["kind"],
+)
+
+# Viewers
+sse_subscribers = Gauge("nkp_sse_subscribers", "Connected live event stream viewers", ["stream"])
+sse_bytes_sent = Counter("nkp_sse_bytes_sent_total", "Bytes of server-sent events written to viewers", ["stream"])
+
+# Event loop health, see loop_monitor
+loop_lag = Histogram("nkp_event_loop_lag_seconds", "How late the event loop ran a timer callback")
+loop_stalls = Counter("nkp_event_loop_stalls_total", "Times the event loop was blocked past the stall threshold")
+
+
+def observe_deployment(status: str, seconds: float, phase_seconds: Dict[str, float]):
+    """Record a finished deployment's duration and the time spent in each phase."""
+    deployment_duration.labels(status).observe(seconds)
+    for phase, elapsed in phase_seconds.items():
+        phase_duration.labels(phase).observe(elapsed)
+
+
+def render() -> str:
+    return default_registry.render()
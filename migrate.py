@@ -0,0 +1,114 @@
+# migrate.py
+"""Bring the database schema up to date with db.py.
+
+    DATABASE_URL=postgresql://... python migrate.py
+
+Run it once per deploy, before starting the workers; the apps never change
+the schema themselves. Missing tables are created, including the log search
+index; tables that already exist get any columns and indexes added since
+they were created, and new columns that copy existing data are backfilled
+(jobs.cluster_name from the job's parameters). Nothing is dropped or
+altered, so it is safe to re-run.
+"""
+from typing import List, Optional
+
+from sqlalchemy import inspect, text, update
+from sqlalchemy.engine import Connection, Engine
+
+from db import Base, Job, JobLogSearchEntry, SEARCH_INDEX_DDL, get_engine
+
+
+SEARCH_INDEX_TABLE = "job_log_fts"
+
+
+def _add_column(conn: Connection, table, column) -> str:
+    quote = conn.dialect.identifier_preparer.quote
+    column_type = column.type.compile(dialect=conn.dialect)
+    # Added nullable; existing rows have no value and the models supply defaults
+    conn.execute(text(f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {column_type}"))
+    return f"added column {table.name}.{column.name}"
+
+
+def _backfill_cluster_names(conn: Connection) -> Optional[str]:
+    # Jobs from before jobs.cluster_name only have it in their parameters
+    jobs = Job.__table__
+    result = conn.execute(
+        update(jobs)
+        .where(jobs.c.cluster_name.is_(None), jobs.c.parameters["cluster_name"].as_string().is_not(None))
+        .values(cluster_name=jobs.c.parameters["cluster_name"].as_string())
+    )
+    return f"backfilled jobs.cluster_name of {result.rowcount} job(s)" if result.rowcount else None
+
+
+class SchemaOutOfDate(RuntimeError):
+    """The database is missing tables, columns or indexes db.py has."""
+
+
+def missing_schema(engine: Optional[Engine] = None) -> List[str]:
+    """What migrate() would add, without changing anything."""
+    engine = engine if engine is not None else get_engine()
+    missing = []
+    with engine.connect() as conn:
+        inspector = inspect(conn)
+        existing = set(inspector.get_table_names())
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing:
+                missing.append(f"table {table.name}")
+                continue
+            columns = {column["name"] for column in inspector.get_columns(table.name)}
+            missing += [f"column {table.name}.{column.name}" for column in table.columns if column.name not in columns]
+            indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            missing += [f"index {index.name}" for index in table.indexes if index.name not in indexes]
+    return missing
+
+
+def check_schema(engine: Optional[Engine] = None):
+    """Raise SchemaOutOfDate unless migrate.py has been run for this version of db.py."""
+    missing = missing_schema(engine)
+    if missing:
+        raise SchemaOutOfDate(f"Database schema is out of date, run migrate.py (missing {', '.join(missing)})")
+
+
+def migrate(engine: Optional[Engine] = None) -> List[str]:
+    """Apply whatever is missing; returns a description of each change."""
+    engine = engine if engine is not None else get_engine()
+    changes = []
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        existing = set(inspector.get_table_names())
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing:
+                # Fires the after_create DDL, e.g. the log search index
+                table.create(conn)
+                changes.append(f"created table {table.name}")
+                continue
+            columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    changes.append(_add_column(conn, table, column))
+
+        # New columns are filled in before indexes that cover them are built
+        backfilled = _backfill_cluster_names(conn)
+        if backfilled:
+            changes.append(backfilled)
+
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing:
+                continue
+            indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(conn)
+                    changes.append(f"created index {index.name}")
+
+        if JobLogSearchEntry.__tablename__ in existing and SEARCH_INDEX_TABLE not in existing:
+            for ddl in SEARCH_INDEX_DDL:
+                ddl(JobLogSearchEntry.__table__, conn)
+            changes.append(f"created {SEARCH_INDEX_TABLE}")
+    return changes
+
+
+if __name__ == "__main__":
+    for change in migrate():
+        print(change)
+    print("Schema is up to date")
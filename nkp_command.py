@@ -0,0 +1,268 @@
+# nkp_command.py
+import hashlib
+import ipaddress
+import json
+import re
+import shlex
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import urlsplit
+
+
+NKP_CREATE_CLUSTER = ["nkp", "create", "cluster", "nutanix"]
+# Always passed, not settable per request
+FIXED_FLAGS = ["--insecure", "--self-managed"]
+
+_DNS_LABEL = re.compile(r"[a-z0-9]([-a-z0-9]{0,61}[a-z0-9])?")
+_KUBERNETES_VERSION = re.compile(r"v?\d+\.\d+\.\d+")
+_SIZE = re.compile(r"(\d+)\s*(?:Gi|GiB|G|GB)?")
+_DURATION = re.compile(r"(?:\d+(?:\.\d+)?(?:h|m|s|ms))+")
+
+
+def text(value: Any) -> str:
+    value = str(value).strip()
+    if not value:
+        raise ValueError("must not be empty")
+    return value
+
+
+def dns_label(value: Any) -> str:
+    value = text(value)
+    if not _DNS_LABEL.fullmatch(value):
+        raise ValueError("must be lowercase letters, digits and '-', at most 63 characters")
+    return value
+
+
+def positive_int(value: Any) -> str:
+    try:
+        number = int(str(value).strip())
+    except ValueError:
+        raise ValueError("must be a whole number")
+    if number < 1:
+        raise ValueError("must be at least 1")
+    return str(number)
+
+
+def port(value: Any) -> str:
+    number = int(positive_int(value))
+    if number > 65535:
+        raise ValueError("must be a port number")
+    return str(number)
+
+
+def size_gib(value: Any) -> str:
+    """A size in GiB, a bare number or with a Gi/G suffix."""
+    match = _SIZE.fullmatch(str(value).strip())
+    if not match or int(match.group(1)) < 1:
+        raise ValueError("must be a size in GiB, like 80 or 80Gi")
+    return match.group(1)
+
+
+def ip_address(value: Any) -> str:
+    try:
+        return str(ipaddress.ip_address(str(value).strip()))
+    except ValueError:
+        raise ValueError("must be an IP address")
+
+
+def ip_range(value: Any) -> str:
+    """``first-last``, both of the same family with first <= last."""
+    first, dash, last = str(value).strip().partition("-")
+    try:
+        first, last = ipaddress.ip_address(first.strip()), ipaddress.ip_address(last.strip())
+    except ValueError:
+        raise ValueError("must be an IP range, like 10.0.0.10-10.0.0.20")
+    if not dash or first.version != last.version or first > last:
+        raise ValueError("must be an IP range, like 10.0.0.10-10.0.0.20")
+    return f"{first}-{last}"
+
+
+def cidr(value: Any) -> str:
+    try:
+        return str(ipaddress.ip_network(str(value).strip()))
+    except ValueError:
+        raise ValueError("must be a network in CIDR notation, like 10.244.0.0/16")
+
+
+def url(value: Any) -> str:
+    value = text(value)
+    parts = urlsplit(value if "://" in value else f"https://{value}")
+    try:
+        parts.port
+    except ValueError:
+        raise ValueError("must be a URL with a valid port")
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError("must be an http(s) URL or host[:port]")
+    return value
+
+
+def kubernetes_version(value: Any) -> str:
+    value = text(value)
+    if not _KUBERNETES_VERSION.fullmatch(value):
+        raise ValueError("must be a version like v1.29.6")
+    return value if value.startswith("v") else f"v{value}"
+
+
+def duration(value: Any) -> str:
+    """A Go duration; a bare number is minutes."""
+    value = text(value)
+    if value.isdigit():
+        return f"{value}m"
+    if not _DURATION.fullmatch(value):
+        raise ValueError("must be a duration like 60m or 1h30m")
+    return value
+
+
+def name_list(value: Any) -> str:
+    """A comma separated list, or a JSON list."""
+    items = value if isinstance(value, list) else str(value).split(",")
+    items = [str(item).strip() for item in items if str(item).strip()]
+    if not items:
+        raise ValueError("must not be empty")
+    return ",".join(items)
+
+
+@dataclass(frozen=True)
+class Flag:
+    parse: Callable[[Any], str]
+    required: bool = False
+    # Masked when the command is shown or logged
+    secret: bool = False
+
+
+# Every flag of ``nkp create cluster nutanix`` a deployment may set
+FLAGS: Dict[str, Flag] = {
+    # Control plane
+    "cluster-name": Flag(dns_label, required=True),
+    "control-plane-endpoint-ip": Flag(ip_address, required=True),
+    "control-plane-endpoint-port": Flag(port),
+    "control-plane-prism-element-cluster": Flag(text, required=True),
+    "control-plane-subnets": Flag(name_list, required=True),
+    "control-plane-vm-image": Flag(text),
+    "control-plane-cores-per-vcpu": Flag(positive_int),
+    "control-plane-disk-size": Flag(size_gib),
+    "control-plane-memory": Flag(size_gib),
+    "control-plane-pc-project": Flag(text),
+    "control-plane-vcpus": Flag(positive_int),
+    "control-plane-replicas": Flag(positive_int),
+
+    # CSI
+    "csi-storage-container": Flag(text, required=True),
+
+    # Endpoint for Prism central
+    "endpoint": Flag(url, required=True),
+
+    # Kubernetes
+    "kubernetes-service-load-balancer-ip-range": Flag(ip_range, required=True),
+    "kubernetes-pod-network-cidr": Flag(cidr),
+    "kubernetes-service-cidr": Flag(cidr),
+    "kubernetes-version": Flag(kubernetes_version),
+    "namespace": Flag(dns_label),
+
+    # Registry
+    "registry-cacert": Flag(text),
+    "registry-mirror-cacert": Flag(text),
+    "registry-mirror-password": Flag(text, secret=True),
+    "registry-mirror-url": Flag(url),
+    "registry-mirror-username": Flag(text),
+    "registry-password": Flag(text, required=True, secret=True),
+    "registry-url": Flag(url, required=True),
+    "registry-username": Flag(text, required=True),
+
+    # Cluster management
+    "ssh-public-key-file": Flag(text),
+    "ssh-username": Flag(text),
+
+    # Timeout
+    "timeout": Flag(duration),
+
+    # VM image, or both of control-plane-vm-image and worker-vm-image
+    "vm-image": Flag(text),
+
+    # Worker
+    "worker-cores-per-vcpu": Flag(positive_int),
+    "worker-disk-size": Flag(size_gib),
+    "worker-memory": Flag(size_gib),
+    "worker-pc-categories": Flag(name_list),
+    "worker-pc-project": Flag(text),
+    "worker-replicas": Flag(positive_int),
+    "worker-vcpus": Flag(positive_int),
+    "worker-prism-element-cluster": Flag(text, required=True),
+    "worker-subnets": Flag(name_list, required=True),
+    "worker-vm-image": Flag(text),
+}
+REQUIRED_FLAGS = frozenset(name for name, flag in FLAGS.items() if flag.required)
+SECRET_FLAGS = frozenset(name for name, flag in FLAGS.items() if flag.secret)
+
+
+class InvalidFlags(ValueError):
+    """A deployment's flags failed validation; ``errors`` maps flag to problem."""
+
+    def __init__(self, errors: Dict[str, str]):
+        super().__init__("; ".join(f"{flag}: {error}" for flag, error in errors.items()))
+        self.errors = errors
+
+
+def validate_flags(deployment: Dict[str, Any]) -> Dict[str, str]:
+    """Check every flag in one pass and return them normalized.
+
+    Raises InvalidFlags listing all unknown, missing and malformed flags.
+    """
+    values: Dict[str, str] = {}
+    errors: Dict[str, str] = {}
+    for name, value in deployment.items():
+        flag = FLAGS.get(name)
+        if flag is None:
+            errors[name] = "unknown flag"
+            continue
+        if value is None or value == "":
+            continue
+        try:
+            values[name] = flag.parse(value)
+        except ValueError as e:
+            errors[name] = str(e)
+
+    for name in REQUIRED_FLAGS - values.keys() - errors.keys():
+        errors[name] = "required"
+    if "vm-image" not in values and not {"control-plane-vm-image", "worker-vm-image"} <= values.keys():
+        errors.setdefault("vm-image", "required unless control-plane-vm-image and worker-vm-image are set")
+
+    if errors:
+        raise InvalidFlags(dict(sorted(errors.items())))
+    return values
+
+
+def build_argv(deployment: Dict[str, Any]) -> List[str]:
+    """Validated ``nkp create cluster nutanix`` argv, to exec without a shell."""
+    values = validate_flags(deployment)
+    return NKP_CREATE_CLUSTER + [f"--{name}={value}" for name, value in values.items()] + FIXED_FLAGS
+
+
+def flag_value(argv: List[str], name: str) -> Optional[str]:
+    """The value of ``--name=value`` in ``argv``, None if it isn't set."""
+    prefix = f"--{name}="
+    for arg in argv:
+        if arg.startswith(prefix):
+            return arg[len(prefix):]
+    return None
+
+
+def spec_hash(argv: List[str]) -> str:
+    """Identifies a deployment by its command and flags, in whatever order the flags came.
+
+    Flags must be in ``--name=value`` form, as build_argv makes them, so
+    their values are already normalized.
+    """
+    positional = [arg for arg in argv if not arg.startswith("--")]
+    flags = sorted(arg for arg in argv if arg.startswith("--"))
+    return hashlib.sha256(json.dumps([positional, flags]).encode("utf-8")).hexdigest()
+
+
+def display_command(argv: List[str], secrets: Optional[frozenset] = None) -> str:
+    """Shell-quoted ``argv`` with secret flag values masked."""
+    secrets = SECRET_FLAGS if secrets is None else secrets
+    shown = []
+    for arg in argv:
+        name, equals, _ = arg[2:].partition("=")
+        shown.append(f"--{name}=****" if arg.startswith("--") and equals and name in secrets else arg)
+    return shlex.join(shown)
@@ -0,0 +1,187 @@
+# phase_stats.py
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session, load_only
+
+from db import Job
+from progress import NKP_PHASE_MARKERS
+
+
+# nkp's defaults when the replica flags are left out
+DEFAULT_CONTROL_PLANE_REPLICAS = 3
+DEFAULT_WORKER_REPLICAS = 4
+# Time between the job starting and nkp reporting its first phase
+STARTING_PHASE = "starting"
+PHASE_ORDER = [STARTING_PHASE] + list(dict.fromkeys(
+    marker.phase for marker in sorted(NKP_PHASE_MARKERS, key=lambda marker: marker.progress)
+))
+# Completed jobs the statistics are built from, newest first
+HISTORY_LIMIT = 500
+# Seconds before the statistics are rebuilt, sooner when a job finishes
+REFRESH_INTERVAL = 300
+# Fewer samples than this and a broader group is used instead
+MIN_SAMPLES = 3
+# A phase is slow past this quantile of its history and this multiple of its median
+SLOW_QUANTILE = 0.95
+SLOW_FACTOR = 1.5
+
+Shape = Tuple[int, int, Optional[str]]
+
+
+def job_shape(parameters: Optional[Dict[str, Any]]) -> Shape:
+    """(control plane replicas, worker replicas, Prism Element cluster) of a job."""
+    flags = (parameters or {}).get("flags") or {}
+
+    def replicas(flag: str, default: int) -> int:
+        try:
+            return int(flags.get(flag, default))
+        except (TypeError, ValueError):
+            return default
+
+    return (
+        replicas("control-plane-replicas", DEFAULT_CONTROL_PLANE_REPLICAS),
+        replicas("worker-replicas", DEFAULT_WORKER_REPLICAS),
+        flags.get("control-plane-prism-element-cluster") or flags.get("worker-prism-element-cluster"),
+    )
+
+
+def phase_durations(started_at: Optional[datetime], timeline: Optional[List[dict]]) -> Dict[str, float]:
+    """Seconds spent in each finished phase of a phase timeline."""
+    durations: Dict[str, float] = defaultdict(float)
+    if started_at is not None and timeline:
+        durations[STARTING_PHASE] = (datetime.fromisoformat(timeline[0]["started_at"]) - started_at).total_seconds()
+    for entry in timeline or ():
+        if entry.get("finished_at"):
+            durations[entry["phase"]] += (
+                datetime.fromisoformat(entry["finished_at"]) - datetime.fromisoformat(entry["started_at"])
+            ).total_seconds()
+    return dict(durations)
+
+
+def quantile(samples: List[float], q: float) -> float:
+    """Nearest-rank quantile of sorted ``samples``."""
+    return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+
+class PhaseStats:
+    """Per-phase duration distributions of completed jobs, grouped by shape.
+
+    Each job counts towards its exact shape, its replica counts on any Prism
+    Element cluster, and all jobs; lookups use the narrowest of those groups
+    with at least ``MIN_SAMPLES`` samples.
+    """
+
+    def __init__(self, history_limit: int = HISTORY_LIMIT, refresh_interval: float = REFRESH_INTERVAL):
+        self.history_limit = history_limit
+        self.refresh_interval = refresh_interval
+        # group key -> phase -> sorted durations, and group key -> job count
+        self._samples: Dict[tuple, Dict[str, List[float]]] = {}
+        self._jobs: Dict[tuple, int] = {}
+        self._loaded_at: Optional[float] = None
+
+    @staticmethod
+    def _groups(shape: Shape) -> List[tuple]:
+        control_plane, workers, prism_element = shape
+        return [("shape", control_plane, workers, prism_element), ("replicas", control_plane, workers), ("all",)]
+
+    def invalidate(self):
+        self._loaded_at = None
+
+    def refresh(self, db: Session, force: bool = False):
+        """Rebuild from the newest completed jobs if the data is stale."""
+        if not force and self._loaded_at is not None and time.monotonic() - self._loaded_at < self.refresh_interval:
+            return
+        jobs = db.query(Job).options(load_only(Job.parameters, Job.started_at, Job.phase_timeline)).filter(
+            Job.status == "completed",
+            Job.phase_timeline.isnot(None),
+        ).order_by(Job.created_at.desc()).limit(self.history_limit).all()
+
+        samples: Dict[tuple, Dict[str, List[float]]] = defaultdict(lambda: defaultdict(list))
+        counts: Dict[tuple, int] = defaultdict(int)
+        for job in jobs:
+            durations = phase_durations(job.started_at, job.phase_timeline)
+            for group in self._groups(job_shape(job.parameters)):
+                counts[group] += 1
+                for phase, seconds in durations.items():
+                    samples[group][phase].append(seconds)
+
+        self._samples = {group: {phase: sorted(values) for phase, values in phases.items()}
+                         for group, phases in samples.items()}
+        self._jobs = dict(counts)
+        self._loaded_at = time.monotonic()
+
+    def distribution(self, shape: Shape, phase: str) -> Tuple[Optional[tuple], List[float]]:
+        """The group used for ``phase`` of a ``shape`` job and its sorted durations."""
+        for group in self._groups(shape):
+            values = self._samples.get(group, {}).get(phase, [])
+            if len(values) >= MIN_SAMPLES:
+                return group, values
+        return None, []
+
+    def summary(self) -> List[dict]:
+        """Duration statistics of every phase, per exact shape."""
+        groups = []
+        for group, phases in sorted(self._samples.items(), key=lambda item: str(item[0])):
+            if group[0] != "shape":
+                continue
+            groups.append({
+                "control_plane_replicas": group[1],
+                "worker_replicas": group[2],
+                "prism_element_cluster": group[3],
+                "jobs": self._jobs[group],
+                "phases": {
+                    phase: {
+                        "count": len(values),
+                        "median_seconds": quantile(values, 0.5),
+                        "p95_seconds": quantile(values, SLOW_QUANTILE),
+                    }
+                    for phase, values in sorted(phases.items(), key=lambda item: PHASE_ORDER.index(item[0])
+                                                if item[0] in PHASE_ORDER else len(PHASE_ORDER))
+                },
+            })
+        return groups
+
+    def estimate(self, parameters: Optional[Dict[str, Any]], started_at: Optional[datetime],
+                 timeline: Optional[List[dict]], now: Optional[datetime] = None) -> Optional[dict]:
+        """ETA and slow phases of a running job, None without enough history."""
+        if started_at is None:
+            return None
+        now = now or datetime.now()
+        shape = job_shape(parameters)
+        timeline = timeline or []
+
+        # Finished phases, plus the running one measured up to now
+        elapsed = phase_durations(started_at, timeline)
+        if timeline:
+            current = timeline[-1]["phase"]
+            if not timeline[-1].get("finished_at"):
+                elapsed[current] = elapsed.get(current, 0) + (
+                    now - datetime.fromisoformat(timeline[-1]["started_at"])
+                ).total_seconds()
+        else:
+            current = STARTING_PHASE
+            elapsed[current] = (now - started_at).total_seconds()
+
+        slow_phases = []
+        for phase, seconds in elapsed.items():
+            _, values = self.distribution(shape, phase)
+            if values and seconds > max(quantile(values, SLOW_QUANTILE), quantile(values, 0.5) * SLOW_FACTOR):
+                slow_phases.append(phase)
+
+        group, values = self.distribution(shape, current)
+        if group is None:
+            return {"eta": None, "remaining_seconds": None, "slow_phases": slow_phases}
+        remaining = max(quantile(values, 0.5) - elapsed[current], 0)
+        # Later phases that most jobs of this shape went through (pivot is optional)
+        later = PHASE_ORDER[PHASE_ORDER.index(current) + 1:] if current in PHASE_ORDER else []
+        for phase in later:
+            values = self._samples[group].get(phase, [])
+            if values and len(values) * 2 >= self._jobs[group]:
+                remaining += quantile(values, 0.5)
+        return {"eta": now + timedelta(seconds=remaining), "remaining_seconds": remaining, "slow_phases": slow_phases}
+
+
+phase_stats = PhaseStats()
@@ -0,0 +1,114 @@
+# process_output.py
+import asyncio
+import codecs
+import time
+from dataclasses import dataclass, asdict
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from metrics import output_bytes, output_lines
+
+
+# Longer lines, and output without a newline, are split into pieces this long
+MAX_LINE_BYTES = 64 * 1024
+READ_SIZE = 64 * 1024
+# How long tail_output waits for more output once a file has been read to its end
+TAIL_INTERVAL = 0.05
+
+
+@dataclass
+class OutputEvent:
+    source: str  # "stdout", "stderr" or "system"
+    line: str
+    timestamp: float
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class LineSplitter:
+    """Cuts one stream's bytes into OutputEvents, a line (or MAX_LINE_BYTES) each.
+
+    Each event comes with the stream offset just past it. ``offset`` counts
+    the bytes emitted so far; an unfinished line held back isn't counted
+    until it is emitted.
+    """
+
+    def __init__(self, source: str, offset: int = 0):
+        self.source = source
+        self.offset = offset
+        # Decoded incrementally, so a character split across reads stays whole
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._buffered = b""
+        self._lines, self._bytes = output_lines.labels(source), output_bytes.labels(source)
+
+    def _emit(self, data: bytes, final: bool = False) -> Tuple[OutputEvent, int]:
+        self._lines.inc()
+        self._bytes.inc(len(data))
+        self.offset += len(data)
+        return OutputEvent(self.source, self._decoder.decode(data, final), time.time()), self.offset
+
+    def feed(self, data: bytes) -> List[Tuple[OutputEvent, int]]:
+        buffered = self._buffered + data
+        events, start = [], 0
+        while (end := buffered.find(b"\n", start)) != -1:
+            events.append(self._emit(buffered[start:end + 1]))
+            start = end + 1
+        buffered = buffered[start:]
+        # A line that never ends mustn't grow without bound
+        while len(buffered) >= MAX_LINE_BYTES:
+            events.append(self._emit(buffered[:MAX_LINE_BYTES]))
+            buffered = buffered[MAX_LINE_BYTES:]
+        self._buffered = buffered
+        return events
+
+    def finish(self) -> List[Tuple[OutputEvent, int]]:
+        """Whatever is left once the stream has ended."""
+        buffered, self._buffered = self._buffered, b""
+        return [self._emit(buffered, final=True)] if buffered else []
+
+
+async def tail_output(paths: Dict[str, str], offsets: Optional[Dict[str, int]] = None,
+                      finished: Callable[[], bool] = lambda: True,
+                      interval: float = TAIL_INTERVAL) -> AsyncIterator[Tuple[OutputEvent, int]]:
+    """Yield lines as they are appended to per-stream log files.
+
+    ``paths`` maps a source ("stdout", "stderr") to the file its output is
+    written to; each is read from its entry in ``offsets``. Every event comes
+    with the file offset just past it, so a reader that stops can carry on
+    from there later. Ends once ``finished()`` is true and the files have
+    been read to their end.
+    """
+    offsets = offsets or {}
+    splitters = {source: LineSplitter(source, offsets.get(source, 0)) for source in paths}
+    files = {}
+    try:
+        while True:
+            # Checked before reading, so output written before the end is still read
+            done = finished()
+            read = False
+            for source, path in paths.items():
+                f = files.get(source)
+                if f is None:
+                    try:
+                        f = files[source] = open(path, "rb")
+                    except FileNotFoundError:
+                        continue
+                    f.seek(splitters[source].offset)
+                data = f.read(READ_SIZE)
+                if data:
+                    read = True
+                    for entry in splitters[source].feed(data):
+                        yield entry
+            if read:
+                # Let other tasks run between reads of a busy file
+                await asyncio.sleep(0)
+            elif done:
+                break
+            else:
+                await asyncio.sleep(interval)
+        for splitter in splitters.values():
+            for entry in splitter.finish():
+                yield entry
+    finally:
+        for f in files.values():
+            f.close()
@@ -0,0 +1,127 @@
+# progress.py
+import re
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+
+@dataclass(frozen=True)
+class PhaseMarker:
+    """A line nkp prints when a deployment phase starts."""
+    phase: str
+    phrase: str
+    progress: int
+
+
+# nkp prints each step as "<spinner or ✓> <phrase>". With --self-managed the
+# CAPI and readiness steps repeat on the new cluster after the pivot; those
+# repeats have lower progress than the pivot and don't move the phase back.
+NKP_PHASE_MARKERS = (
+    PhaseMarker("bootstrap", "Creating a bootstrap cluster", 5),
+    PhaseMarker("capi_providers", "Upgrading CAPI components", 12),
+    PhaseMarker("capi_providers", "Waiting for CAPI components to be upgraded", 15),
+    PhaseMarker("capi_providers", "Initializing new CAPI components", 18),
+    PhaseMarker("cluster_resources", "Creating ClusterClass resources", 25),
+    PhaseMarker("cluster_resources", "Creating a new workload cluster", 30),
+    PhaseMarker("infrastructure", "Waiting for cluster infrastructure to be ready", 40),
+    PhaseMarker("control_plane", "Waiting for cluster control-planes to be ready", 55),
+    PhaseMarker("workers", "Waiting for machines to be ready", 70),
+    PhaseMarker("pivot", "Moving cluster resources", 85),
+    PhaseMarker("cleanup", "Deleting bootstrap cluster", 95),
+)
+
+# Spinner/check glyphs, whitespace and ANSI colour codes before the phrase
+_LINE_PREFIX = r"^(?:\x1b\[[0-9;]*m|[^\w\x1b])*"
+
+
+def _trie_pattern(phrases: Iterable[str]) -> str:
+    """Regex matching any of ``phrases``, factored into a prefix trie.
+
+    Each character position branches only on the distinct characters that
+    follow it, so matching walks one path instead of trying every phrase.
+    """
+    trie: dict = {}
+    for phrase in phrases:
+        node = trie
+        for char in phrase:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def emit(node: dict) -> str:
+        branches = [re.escape(char) + emit(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return f"(?:{pattern})?" if "" in node else pattern
+
+    return emit(trie)
+
+
+class ProgressEngine:
+    """Maps output lines to phase markers with one precompiled matcher.
+
+    The matcher is anchored at the start of the line's text and built as a
+    trie, so the per-line cost depends on the line, not on how many markers
+    the table has.
+    """
+
+    def __init__(self, markers: Iterable[PhaseMarker] = NKP_PHASE_MARKERS):
+        self.markers: Dict[str, PhaseMarker] = {marker.phrase: marker for marker in markers}
+        self._matcher = re.compile(_LINE_PREFIX + "(" + _trie_pattern(self.markers) + ")")
+
+    def match(self, line: str) -> Optional[PhaseMarker]:
+        # Spinners redraw with carriage returns, the phrase is the same each time
+        match = self._matcher.match(line.rpartition("\r")[2])
+        if match is None:
+            return None
+        # The trie can stop at a shorter phrase that prefixes a longer one
+        return self.markers.get(match.group(1))
+
+    def tracker(self, timeline: Optional[List[dict]] = None) -> "PhaseTracker":
+        return PhaseTracker(self, timeline)
+
+
+class PhaseTracker:
+    """Phase, progress and phase timeline of one job."""
+
+    def __init__(self, engine: ProgressEngine, timeline: Optional[List[dict]] = None):
+        self.engine = engine
+        self.timeline: List[dict] = list(timeline or [])
+        last = self.timeline[-1] if self.timeline else None
+        self.phase: Optional[str] = last["phase"] if last else None
+        self.progress: int = last["progress"] if last else 0
+
+    def feed(self, line: str, now: Optional[datetime] = None) -> Optional[PhaseMarker]:
+        """Advance on ``line``; returns the marker if progress moved forward."""
+        marker = self.engine.match(line)
+        if marker is None or marker.progress <= self.progress:
+            return None
+        self.progress = marker.progress
+        if marker.phase != self.phase:
+            now = (now or datetime.now()).isoformat()
+            if self.timeline:
+                self.timeline[-1]["finished_at"] = now
+            self.timeline.append({"phase": marker.phase, "progress": marker.progress,
+                                  "started_at": now, "finished_at": None})
+            self.phase = marker.phase
+        else:
+            self.timeline[-1]["progress"] = marker.progress
+        return marker
+
+    def finish(self, now: Optional[datetime] = None):
+        """Close the running phase when the job ends."""
+        if self.timeline and self.timeline[-1]["finished_at"] is None:
+            self.timeline[-1]["finished_at"] = (now or datetime.now()).isoformat()
+
+    def durations(self) -> Dict[str, float]:
+        """Seconds spent in each finished phase."""
+        durations: Dict[str, float] = {}
+        for entry in self.timeline:
+            if entry["finished_at"]:
+                seconds = (datetime.fromisoformat(entry["finished_at"])
+                           - datetime.fromisoformat(entry["started_at"])).total_seconds()
+                durations[entry["phase"]] = durations.get(entry["phase"], 0.0) + seconds
+        return durations
+
+
+progress_engine = ProgressEngine()
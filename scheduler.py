@@ -0,0 +1,158 @@
+# scheduler.py
+import asyncio
+import itertools
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional
+
+
+@dataclass
+class QueuedDeployment:
+    job_id: str
+    endpoint: Optional[str]
+    priority: int
+    run: Callable[[], Awaitable[None]]
+    enqueued_at: float
+    order: int = field(default=0)
+    # time.monotonic() before which it isn't started
+    not_before: float = field(default=0.0)
+
+    @property
+    def sort_key(self):
+        # Higher priority first, then first come first served
+        return (-self.priority, self.order)
+
+
+class DeploymentScheduler:
+    """Runs deployments from a priority queue under concurrency limits.
+
+    At most ``max_concurrent`` deployments run at once, and at most
+    ``max_per_endpoint`` (or the override in ``endpoint_limits``) against the
+    same Prism Central endpoint. A queued deployment whose endpoint is at its
+    limit is skipped over, so it doesn't hold up deployments to other
+    endpoints behind it.
+    """
+
+    def __init__(self, max_concurrent: int = 4, max_per_endpoint: int = 2,
+                 endpoint_limits: Optional[Dict[str, int]] = None):
+        self.max_concurrent = max_concurrent
+        self.max_per_endpoint = max_per_endpoint
+        self.endpoint_limits = endpoint_limits or {}
+
+        self._queue: List[QueuedDeployment] = []
+        self._running: Dict[str, QueuedDeployment] = {}
+        self._per_endpoint: Counter = Counter()
+        self._order = itertools.count()
+        self._changed: Optional[asyncio.Condition] = None
+        self._workers: List[asyncio.Task] = []
+
+    def submit(self, job_id: str, run: Callable[[], Awaitable[None]],
+               endpoint: Optional[str] = None, priority: int = 0,
+               enqueued_at: Optional[float] = None, delay: float = 0.0) -> int:
+        """Queue ``run`` and return its 1-based queue position.
+
+        With a ``delay`` it is queued, but not started, until that many
+        seconds have passed; e.g. to try again for a slot taken elsewhere.
+        """
+        self._ensure_workers()
+        item = QueuedDeployment(job_id, endpoint, priority, run,
+                                enqueued_at if enqueued_at is not None else time.time(),
+                                next(self._order), time.monotonic() + delay)
+        self._queue.append(item)
+        self._queue.sort(key=lambda queued: queued.sort_key)
+        self._notify()
+        if delay:
+            asyncio.get_running_loop().call_later(delay, self._notify)
+        return self.position(job_id)
+
+    def adopt(self, job_id: str, run: Callable[[], Awaitable[None]], endpoint: Optional[str] = None):
+        """Run ``run`` now for a deployment that is already underway.
+
+        Meant for deployments reattached after a restart: their process is
+        running whatever the limits say, so it isn't queued, but it counts
+        against the limits until ``run`` returns.
+        """
+        self._ensure_workers()
+        item = QueuedDeployment(job_id, endpoint, 0, run, time.time(), next(self._order))
+        self._claim(item)
+        asyncio.get_running_loop().create_task(self._run(item))
+
+    def position(self, job_id: str) -> Optional[int]:
+        """1-based position among queued deployments, None if not queued."""
+        for index, item in enumerate(self._queue):
+            if item.job_id == job_id:
+                return index + 1
+        return None
+
+    def queued_seconds(self, job_id: str) -> Optional[float]:
+        for item in self._queue:
+            if item.job_id == job_id:
+                return time.time() - item.enqueued_at
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self._queue),
+            "running": len(self._running),
+            "max_concurrent": self.max_concurrent,
+            "running_per_endpoint": dict(self._per_endpoint),
+        }
+
+    def limit_for(self, endpoint: Optional[str]) -> int:
+        """How many deployments may run against ``endpoint`` at once."""
+        return self.endpoint_limits.get(endpoint, self.max_per_endpoint)
+
+    def _pop_admissible(self) -> Optional[QueuedDeployment]:
+        # Adopted deployments take slots without a worker
+        if len(self._running) >= self.max_concurrent:
+            return None
+        now = time.monotonic()
+        for index, item in enumerate(self._queue):
+            if item.not_before > now:
+                continue
+            if item.endpoint is None or self._per_endpoint[item.endpoint] < self.limit_for(item.endpoint):
+                return self._queue.pop(index)
+        return None
+
+    def _ensure_workers(self):
+        if self._workers:
+            return
+        self._changed = asyncio.Condition()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrent)]
+
+    def _notify(self):
+        async def notify():
+            async with self._changed:
+                self._changed.notify_all()
+        asyncio.get_running_loop().create_task(notify())
+
+    async def _worker(self):
+        while True:
+            async with self._changed:
+                item = self._pop_admissible()
+                while item is None:
+                    await self._changed.wait()
+                    item = self._pop_admissible()
+                self._claim(item)
+            await self._run(item)
+
+    def _claim(self, item: QueuedDeployment):
+        self._running[item.job_id] = item
+        if item.endpoint is not None:
+            self._per_endpoint[item.endpoint] += 1
+
+    async def _run(self, item: QueuedDeployment):
+        try:
+            await item.run()
+        except Exception:
+            # The run reports its own failures, keep the worker alive
+            pass
+        finally:
+            async with self._changed:
+                del self._running[item.job_id]
+                if item.endpoint is not None:
+                    self._per_endpoint[item.endpoint] -= 1
+                    if not self._per_endpoint[item.endpoint]:
+                        del self._per_endpoint[item.endpoint]
+                self._changed.notify_all()
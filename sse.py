@@ -0,0 +1,87 @@
+# sse.py
+import zlib
+from typing import AsyncIterator, Dict, Optional, Union
+
+from fastapi.responses import StreamingResponse
+
+from metrics import sse_bytes_sent, sse_subscribers
+
+
+def format_sse(data: str, event: Optional[str] = None, event_id: Optional[Union[int, str]] = None) -> str:
+    message = f"id: {event_id}\n" if event_id is not None else ""
+    if event:
+        message += f"event: {event}\n"
+    return message + f"data: {data}\n\n"
+
+
+# Comment frame that keeps idle connections from being closed by proxies
+KEEPALIVE = ": keepalive\n\n"
+
+# Longest a viewer may ask for events to be held back and sent together
+MAX_BATCH_WINDOW_MS = 1000
+# Lines sent together at most, unless a viewer asks for another limit
+DEFAULT_BATCH_LINES = 200
+
+# Event streams are small JSON frames, a low level compresses them nearly as well
+COMPRESSION_LEVEL = 5
+# zlib window bits for each content coding we offer, in order of preference
+ENCODINGS = {"gzip": 31, "deflate": 15}
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """The content coding of ENCODINGS the client prefers, None for identity."""
+    weights: Dict[str, float] = {}
+    for coding in (accept_encoding or "").split(","):
+        name, _, params = coding.partition(";")
+        name = name.strip().lower()
+        name = "gzip" if name == "x-gzip" else name
+        if name not in ENCODINGS:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights.setdefault(name, q)
+    # Ties go to the first of ENCODINGS
+    best = max(ENCODINGS, key=lambda name: weights.get(name, 0.0))
+    return best if weights.get(best, 0.0) > 0 else None
+
+
+async def compressed(frames: AsyncIterator[str], encoding: str) -> AsyncIterator[bytes]:
+    """``frames`` compressed as one ``encoding`` stream.
+
+    Every frame is sync-flushed, so the client can decode it as soon as it
+    arrives instead of waiting for the compressor to fill a block.
+    """
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, ENCODINGS[encoding])
+    async for frame in frames:
+        yield compressor.compress(frame.encode("utf-8")) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+async def metered(frames: AsyncIterator[Union[str, bytes]], stream: str) -> AsyncIterator[Union[str, bytes]]:
+    """Pass ``frames`` through, counting the viewer and the bytes sent to it."""
+    viewers, sent = sse_subscribers.labels(stream), sse_bytes_sent.labels(stream)
+    viewers.inc()
+    try:
+        async for frame in frames:
+            # Frames are ASCII (json.dumps escapes everything else) or compressed bytes
+            sent.inc(len(frame))
+            yield frame
+    finally:
+        viewers.dec()
+
+
+def event_stream_response(frames: AsyncIterator[str], stream: str, accept_encoding: Optional[str] = None,
+                          headers: Optional[Dict[str, str]] = None) -> StreamingResponse:
+    """A metered text/event-stream of ``frames``, compressed if the client accepts it."""
+    headers = {**(headers or {}), "Vary": "Accept-Encoding"}
+    encoding = negotiate_encoding(accept_encoding)
+    if encoding is not None:
+        frames = compressed(frames, encoding)
+        headers["Content-Encoding"] = encoding
+    return StreamingResponse(metered(frames, stream), media_type="text/event-stream", headers=headers)
@@ -0,0 +1,53 @@
+# templating.py
+"""Jinja templates for the apps, loaded from the package directory.
+
+    python templating.py
+
+compiles every template into the bytecode cache ahead of time (e.g. while
+building the image), so workers start by loading compiled templates.
+"""
+import functools
+import os
+import tempfile
+from typing import List
+
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_DIR = os.path.join(PACKAGE_DIR, "templates")
+STATIC_DIR = os.path.join(PACKAGE_DIR, "static")
+# Shared by all workers; Jinja replaces cache files atomically
+TEMPLATE_CACHE_DIR = os.environ.get("NKP_TEMPLATE_CACHE", os.path.join(tempfile.gettempdir(), "nkp-template-cache"))
+
+
+@functools.lru_cache(maxsize=None)
+def templates_for(directory: str = TEMPLATE_DIR):
+    """Jinja2Templates for ``directory``, built on first use.
+
+    Jinja is only imported once a page is rendered, and compiled templates
+    are kept in a bytecode cache on disk instead of being compiled again by
+    every worker.
+    """
+    import jinja2
+    from fastapi.templating import Jinja2Templates
+
+    os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+    env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(directory),
+        autoescape=True,
+        bytecode_cache=jinja2.FileSystemBytecodeCache(TEMPLATE_CACHE_DIR),
+    )
+    return Jinja2Templates(env=env)
+
+
+def precompile(directory: str = TEMPLATE_DIR) -> List[str]:
+    """Compile every template under ``directory`` into the bytecode cache."""
+    env = templates_for(directory).env
+    names = env.list_templates(extensions=["html"])
+    for name in names:
+        env.get_template(name)
+    return names
+
+
+if __name__ == "__main__":
+    for name in precompile():
+        print(f"compiled {name}")
@@ -0,0 +1,103 @@
+# test_deployments.py
+import asyncio
+import uuid
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import app as app_module
+import deployments
+from deployments import DeploymentRun, replay_from_log
+from process_output import OutputEvent
+
+EVENTS = 7
+
+
+@pytest.fixture
+def run(monkeypatch):
+    """A finished run whose ring buffer only holds its last three events."""
+    monkeypatch.setattr(deployments, "RING_BUFFER_SIZE", 3)
+    run = DeploymentRun(str(uuid.uuid4()), ["nkp", "create", "cluster"])
+    for i in range(1, EVENTS + 1):
+        run._append(OutputEvent("stdout", f"line {i}\n", float(i)), offset=i * 7)
+    run.done = True
+    monkeypatch.setitem(deployments.runs, run.job_id, run)
+    return run
+
+
+def follow(run, last_event_id):
+    async def collect():
+        return [(event_id, event.line) async for event_id, event in run.follow(last_event_id)]
+    return asyncio.run(collect())
+
+
+def expected_after(last_event_id):
+    return [(i, f"line {i}\n") for i in range(last_event_id + 1, EVENTS + 1)]
+
+
+def test_replay_from_log(run):
+    assert [event_id for event_id, _ in replay_from_log(run.job_id)] == list(range(1, EVENTS + 1))
+    assert [event_id for event_id, _ in replay_from_log(run.job_id, 2, before=5)] == [3, 4]
+    assert replay_from_log(str(uuid.uuid4())) is None
+
+
+@pytest.mark.parametrize("last_event_id", range(EVENTS + 2))
+def test_follow_replays_what_the_ring_buffer_dropped_from_the_log(run, last_event_id):
+    assert run.events.first_id == EVENTS - 2
+    assert follow(run, last_event_id) == expected_after(last_event_id)
+
+
+def test_follow_carries_on_with_live_events(run):
+    run.done = False
+
+    async def main():
+        received = []
+
+        async def viewer():
+            async for event_id, _ in run.follow(2):
+                received.append(event_id)
+
+        task = asyncio.create_task(viewer())
+        await asyncio.sleep(0)
+        for i in range(EVENTS + 1, EVENTS + 4):
+            run._append(OutputEvent("stdout", f"line {i}\n", float(i)))
+            await asyncio.sleep(0)
+        for subscriber in run.subscribers:
+            subscriber.close()
+        await asyncio.wait_for(task, 1)
+        return received
+
+    assert asyncio.run(main()) == list(range(3, EVENTS + 4))
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.include_router(app_module.router)
+    return TestClient(app)
+
+
+def streamed_ids(response):
+    return [int(line[len("id: "):]) for line in response.text.splitlines() if line.startswith("id: ")]
+
+
+@pytest.mark.parametrize("last_event_id", [0, 1, 4, EVENTS])
+def test_stream_resumes_after_last_event_id(run, client, last_event_id):
+    response = client.get(f"/deploy/management/{run.job_id}/stream", headers={"Last-Event-ID": str(last_event_id)})
+
+    assert streamed_ids(response) == list(range(last_event_id + 1, EVENTS + 1))
+    assert response.text.rstrip().endswith("data: [DONE]")
+
+
+def test_stream_after_overrides_last_event_id(run, client):
+    response = client.get(f"/deploy/management/{run.job_id}/stream?after=5", headers={"Last-Event-ID": "1"})
+
+    assert streamed_ids(response) == [6, 7]
+
+
+def test_stream_of_a_run_only_on_disk_replays_the_log(run, client, monkeypatch):
+    monkeypatch.delitem(deployments.runs, run.job_id)
+    response = client.get(f"/deploy/management/{run.job_id}/stream", headers={"Last-Event-ID": "3"})
+
+    assert streamed_ids(response) == [4, 5, 6, 7]
@@ -0,0 +1,89 @@
+# test_fanout.py
+import asyncio
+
+import pytest
+
+from fanout import OverflowPolicy, RingBuffer, Subscriber, SubscriberOverflow
+
+
+def drain(subscriber):
+    async def collect():
+        return [item async for item in subscriber]
+    subscriber.close()
+    return asyncio.run(collect())
+
+
+def add(older, newer):
+    # Merges numbers, refuses anything else
+    return older + newer if isinstance(older, int) and isinstance(newer, int) else None
+
+
+def test_drop_oldest_keeps_the_newest_items():
+    subscriber = Subscriber(3, OverflowPolicy.DROP_OLDEST)
+    for item in range(1, 6):
+        subscriber.push(item)
+
+    assert subscriber.dropped == 2
+    assert drain(subscriber) == [3, 4, 5]
+
+
+def test_coalesce_merges_into_the_newest_queued_item():
+    subscriber = Subscriber(3, OverflowPolicy.COALESCE, coalesce=add)
+    for item in range(1, 6):
+        subscriber.push(item)
+
+    assert subscriber.dropped == 0
+    assert drain(subscriber) == [1, 2, 3 + 4 + 5]
+
+
+def test_coalesce_drops_the_oldest_when_items_cant_merge():
+    subscriber = Subscriber(3, OverflowPolicy.COALESCE, coalesce=add)
+    for item in [1, 2, "x", 3]:
+        subscriber.push(item)
+
+    assert subscriber.dropped == 1
+    assert drain(subscriber) == [2, "x", 3]
+
+
+def test_coalesce_without_a_merge_function_drops_the_oldest():
+    subscriber = Subscriber(2, OverflowPolicy.COALESCE)
+    for item in range(1, 4):
+        subscriber.push(item)
+
+    assert drain(subscriber) == [2, 3]
+
+
+def test_disconnect_ends_the_subscription_on_overflow():
+    subscriber = Subscriber(2, OverflowPolicy.DISCONNECT)
+    for item in range(1, 4):
+        subscriber.push(item)
+    # Ignored once disconnected
+    subscriber.push(4)
+
+    assert subscriber.closed and subscriber.overflowed
+    with pytest.raises(SubscriberOverflow):
+        # Even the items still queued aren't handed out, the client resumes by id
+        asyncio.run(subscriber.__anext__())
+
+
+def test_subscriber_wakes_a_waiting_consumer():
+    async def main():
+        subscriber = Subscriber(10)
+        consumer = asyncio.create_task(subscriber.__anext__())
+        await asyncio.sleep(0)
+        subscriber.push("line")
+        return await asyncio.wait_for(consumer, 1)
+
+    assert asyncio.run(main()) == "line"
+
+
+def test_ring_buffer_ids_and_since():
+    buffer = RingBuffer(3)
+    assert buffer.first_id == 1 and buffer.since(0) == []
+    for item in "abcde":
+        buffer.append(item)
+
+    assert buffer.first_id == 3 and buffer.last_id == 5
+    assert buffer.since(0) == [(3, "c"), (4, "d"), (5, "e")]
+    assert buffer.since(3) == [(4, "d"), (5, "e")]
+    assert buffer.since(5) == []
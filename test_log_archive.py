@@ -0,0 +1,105 @@
+# test_log_archive.py
+import gzip
+
+import pytest
+from fastapi import FastAPI, Header
+from fastapi.testclient import TestClient
+
+from log_archive import LogArchive, LogArchiveWriter, archive_response
+
+DATA = b"".join(b"line %03d\n" % i for i in range(100))
+
+
+@pytest.fixture
+def archive(workdir):
+    writer = LogArchiveWriter(str(workdir / "stdout"), segment_size=64)
+    # Written in pieces that don't line up with the segments
+    for start in range(0, len(DATA), 50):
+        writer.write(DATA[start:start + 50])
+    writer.close()
+    return LogArchive(str(workdir / "stdout"))
+
+
+@pytest.fixture
+def client(archive):
+    app = FastAPI()
+
+    @app.get("/log")
+    def log(range: str = Header(None), accept_encoding: str = Header(None)):
+        return archive_response(archive, range, accept_encoding, "stdout.log")
+
+    return TestClient(app)
+
+
+def get(client, range_header=None, accept_encoding="identity"):
+    headers = {"Accept-Encoding": accept_encoding}
+    if range_header is not None:
+        headers["Range"] = range_header
+    return client.get("/log", headers=headers)
+
+
+def test_archive_is_one_gzip_file_of_indexed_segments(archive):
+    assert archive.size == len(DATA)
+    assert len(archive.segments) > 1
+    with open(f"{archive.path}.gz", "rb") as f:
+        assert gzip.decompress(f.read()) == DATA
+
+
+@pytest.mark.parametrize("start,end", [(0, None), (0, 1), (63, 65), (64, 128), (100, 500), (len(DATA) - 1, None)])
+def test_iter_range_crosses_segments(archive, start, end):
+    assert b"".join(archive.iter_range(start, end)) == DATA[start:end]
+
+
+@pytest.mark.parametrize("range_header,start,end", [
+    ("bytes=0-9", 0, 10),
+    ("bytes=60-70", 60, 71),
+    ("bytes=890-", 890, len(DATA)),
+    ("bytes=-5", len(DATA) - 5, len(DATA)),
+    # Ends past the end, or a suffix longer than the log, are cut to it
+    ("bytes=895-5000", 895, len(DATA)),
+    ("bytes=-5000", 0, len(DATA)),
+])
+def test_range_is_answered_with_206(client, range_header, start, end):
+    response = get(client, range_header)
+
+    assert response.status_code == 206
+    assert response.content == DATA[start:end]
+    assert response.headers["Content-Range"] == f"bytes {start}-{end - 1}/{len(DATA)}"
+    assert response.headers["Content-Length"] == str(end - start)
+    assert "Content-Encoding" not in response.headers
+
+
+@pytest.mark.parametrize("range_header", ["bytes=900-", "bytes=5000-6000", "bytes=10-5", "bytes=-0"])
+def test_unsatisfiable_range_is_416(client, range_header):
+    response = get(client, range_header)
+
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == f"bytes */{len(DATA)}"
+
+
+@pytest.mark.parametrize("range_header", ["bytes=-", "items=0-5", "bytes=0-5,10-15"])
+def test_range_that_isnt_a_single_byte_range_gets_everything(client, range_header):
+    response = get(client, range_header)
+
+    assert response.status_code == 200
+    assert response.content == DATA
+
+
+def test_full_download_passes_gzip_through(client, archive):
+    with client.stream("GET", "/log", headers={"Accept-Encoding": "gzip"}) as response:
+        # Undecoded: httpx would stop after the first gzip member
+        body = b"".join(response.iter_raw())
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Content-Length"] == str(archive.compressed_size) == str(len(body))
+    assert gzip.decompress(body) == DATA
+
+
+@pytest.mark.parametrize("accept_encoding", ["identity", "gzip;q=0", "br"])
+def test_full_download_is_uncompressed_unless_gzip_is_accepted(client, accept_encoding):
+    response = get(client, accept_encoding=accept_encoding)
+
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["Content-Length"] == str(len(DATA))
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.content == DATA
@@ -0,0 +1,135 @@
+# test_log_store.py
+import pytest
+from sqlalchemy import update
+
+from db import Job, JobLogChunk, SessionLocal
+from log_archive import LogArchive, job_archive_path
+from log_store import JobLogWriter, archive_job_logs, read_log_from
+
+
+def chunks_of(job_id):
+    with SessionLocal() as db:
+        return db.query(JobLogChunk.seq, JobLogChunk.stream, JobLogChunk.byte_offset, JobLogChunk.byte_length).filter(
+            JobLogChunk.job_id == job_id
+        ).order_by(JobLogChunk.seq).all()
+
+
+def read_all(job_id, stream, offset=0):
+    with SessionLocal() as db:
+        job = db.query(Job).filter(Job.id == job_id).one()
+        return read_log_from(db, job, stream, offset)
+
+
+def test_writer_coalesces_runs_of_one_stream_into_chunks(make_job):
+    job_id = make_job()
+    writer = JobLogWriter(job_id)
+    for stream, text in [("stdout", "a\n"), ("stdout", "b\n"), ("stderr", "e\n"), ("stdout", "c\n")]:
+        writer.write(stream, text)
+    writer.flush()
+
+    assert chunks_of(job_id) == [(0, "stdout", 0, 4), (1, "stderr", 0, 2), (2, "stdout", 4, 2)]
+
+
+def test_writer_resumes_seq_and_byte_offsets(make_job):
+    job_id = make_job()
+    writer = JobLogWriter(job_id)
+    # Offsets count UTF-8 bytes, not characters
+    writer.write("stdout", "héllo\n")
+    writer.write("stderr", "wärning\n")
+    writer.flush()
+
+    resumed = JobLogWriter(job_id)
+    resumed.write("stdout", "wörld\n")
+    resumed.write("stderr", "again\n")
+    resumed.flush()
+
+    assert chunks_of(job_id) == [
+        (0, "stdout", 0, 7), (1, "stderr", 0, 9), (2, "stdout", 7, 7), (3, "stderr", 9, 6),
+    ]
+    assert read_all(job_id, "stdout") == ("héllo\nwörld\n", 14)
+    assert read_all(job_id, "stderr") == ("wärning\nagain\n", 15)
+
+
+def test_writer_resumes_source_offsets(make_job):
+    job_id = make_job()
+    writer = JobLogWriter(job_id)
+    writer.write("stdout", "one\n", source_offset=4)
+    writer.write("stdout", "two\n", source_offset=8)
+    writer.write("stderr", "err\n", source_offset=4)
+    writer.flush()
+    writer.write("stdout", "three\n", source_offset=14)
+    writer.set_progress(10)
+
+    assert JobLogWriter(job_id).source_offsets == {"stdout": 14, "stderr": 4}
+
+
+def test_writer_keeps_its_position_when_a_commit_fails(make_job, monkeypatch):
+    job_id = make_job()
+    writer = JobLogWriter(job_id)
+    writer.write("stdout", "kept\n")
+    writer.flush()
+
+    def failing_session():
+        raise RuntimeError("database went away")
+
+    writer.session_factory = failing_session
+    writer.write("stdout", "lost\n")
+    with pytest.raises(RuntimeError):
+        writer.flush()
+    writer.session_factory = SessionLocal
+    writer.write("stdout", "next\n")
+    writer.flush()
+
+    # No gap in seq or offsets where the failed chunk would have been
+    assert chunks_of(job_id) == [(0, "stdout", 0, 5), (1, "stdout", 5, 5)]
+    assert read_all(job_id, "stdout") == ("kept\nnext\n", 10)
+
+
+@pytest.fixture
+def legacy_job(make_job):
+    """A job with output in the legacy column followed by chunks, as bytes per stream."""
+    job_id = make_job(status="completed", stdout="légacy\n", stderr="")
+    writer = JobLogWriter(job_id)
+    writer.write("stdout", "chünk one\n")
+    writer.write("stderr", "only chunks\n")
+    writer.flush()
+    writer.write("stdout", "chunk two\n")
+    writer.flush()
+    return job_id, {
+        "stdout": "légacy\nchünk one\nchunk two\n".encode("utf-8"),
+        "stderr": "only chunks\n".encode("utf-8"),
+    }
+
+
+def expected_from(data: bytes, offset: int):
+    return data[offset:].decode("utf-8", errors="replace"), max(len(data), offset)
+
+
+@pytest.mark.parametrize("stream", ["stdout", "stderr"])
+def test_read_log_from_spans_legacy_column_and_chunks(legacy_job, stream):
+    job_id, data = legacy_job
+    for offset in range(len(data[stream]) + 3):
+        assert read_all(job_id, stream, offset) == expected_from(data[stream], offset), offset
+
+
+@pytest.mark.parametrize("stream", ["stdout", "stderr"])
+def test_read_log_from_reads_the_archive_at_the_same_offsets(legacy_job, stream):
+    job_id, data = legacy_job
+    archive_job_logs(job_id)
+
+    assert chunks_of(job_id) == []
+    assert LogArchive.open(job_archive_path(job_id, stream)).size == len(data[stream])
+    for offset in range(len(data[stream]) + 3):
+        assert read_all(job_id, stream, offset) == expected_from(data[stream], offset), offset
+
+
+def test_archive_job_logs_skips_a_job_another_worker_claimed(legacy_job):
+    job_id, data = legacy_job
+    with SessionLocal() as db:
+        db.execute(update(Job).where(Job.id == job_id).values(logs_archiving_at=Job.created_at))
+        db.commit()
+    # Claimed just now as far as the timeout goes, the created_at of a fresh job
+    archive_job_logs(job_id)
+
+    assert LogArchive.open(job_archive_path(job_id, "stdout")) is None
+    assert read_all(job_id, "stdout") == expected_from(data["stdout"], 0)
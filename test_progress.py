@@ -0,0 +1,45 @@
+# test_progress.py
+from datetime import datetime, timedelta
+
+import pytest
+
+from progress import NKP_PHASE_MARKERS, PhaseMarker, ProgressEngine, progress_engine
+
+
+@pytest.mark.parametrize("marker", NKP_PHASE_MARKERS, ids=lambda marker: marker.phrase)
+def test_every_marker_matches_with_nkp_line_prefixes(marker):
+    for line in (f"{marker.phrase}\n", f" • {marker.phrase}\n", f" ✓ {marker.phrase} ...\n",
+                 f"\x1b[32m✓\x1b[0m {marker.phrase}\n", f"\r⠋ something\r ✓ {marker.phrase}\n"):
+        assert progress_engine.match(line) == marker, line
+
+
+@pytest.mark.parametrize("line", [
+    "",
+    "\n",
+    "Creating a bootstrap\n",
+    "I1018 12:00:00 controller.go:42] Creating a bootstrap cluster\n",
+    "creating a bootstrap cluster\n",
+    " ✓ Waiting for cluster something else\n",
+])
+def test_other_lines_dont_match(line):
+    assert progress_engine.match(line) is None
+
+
+def test_longest_phrase_wins_and_a_prefix_still_matches_alone():
+    short, long = PhaseMarker("a", "Waiting", 10), PhaseMarker("b", "Waiting for pods", 20)
+    engine = ProgressEngine([short, long])
+
+    assert engine.match(" • Waiting for pods to start\n") == long
+    assert engine.match(" • Waiting for nodes\n") == short
+    assert engine.match(" • Waiting\n") == short
+
+
+def test_tracker_moves_forward_only():
+    tracker = progress_engine.tracker()
+    start = datetime(2026, 1, 1)
+    assert tracker.feed(" • Creating a bootstrap cluster\n", start).phase == "bootstrap"
+    tracker.feed(" • Moving cluster resources\n", start + timedelta(minutes=5))
+    # After the pivot the CAPI steps repeat on the new cluster
+    tracker.feed(" • Upgrading CAPI components\n", start + timedelta(minutes=6))
+
+    assert (tracker.phase, tracker.progress) == ("pivot", 85)
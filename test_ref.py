@@ -0,0 +1,45 @@
+# test_ref.py
+import pytest
+from sqlalchemy import update
+
+import ref
+from db import Job, SessionLocal
+
+
+@pytest.fixture(autouse=True)
+def no_running_jobs():
+    # Limits count every running job in the database, whichever test made it
+    with SessionLocal() as db:
+        db.execute(update(Job).where(Job.status == "running").values(status="completed"))
+        db.commit()
+
+
+def status_of(job_id):
+    with SessionLocal() as db:
+        return db.query(Job.status).filter(Job.id == job_id).scalar()
+
+
+def test_claim_respects_the_endpoint_limit_of_other_workers_jobs(make_job):
+    for _ in range(ref.scheduler.limit_for("pc")):
+        make_job(status="running", endpoint="pc", host="elsewhere")
+    waiting, other_endpoint = make_job(status="pending", endpoint="pc"), make_job(status="pending", endpoint="pc2")
+
+    assert ref.claim_pending_job(waiting, "pc") is False
+    assert status_of(waiting) == "pending"
+    assert ref.claim_pending_job(other_endpoint, "pc2") is True
+    assert status_of(other_endpoint) == "running"
+
+
+def test_claim_respects_the_global_limit(make_job):
+    for i in range(ref.scheduler.max_concurrent):
+        make_job(status="running", endpoint=f"pc{i}")
+    job_id = make_job(status="pending")
+
+    assert ref.claim_pending_job(job_id) is False
+
+
+def test_claim_of_a_job_taken_elsewhere(make_job):
+    job_id = make_job(status="pending")
+
+    assert ref.claim_pending_job(job_id) is True
+    assert ref.claim_pending_job(job_id) is None